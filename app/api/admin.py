@@ -2,3 +2,5 @@ from django.contrib import admin
 from .models import *
 
 admin.site.register(Notification)
+admin.site.register(ChainProfile)
+admin.site.register(ChainConfig)
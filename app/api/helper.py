@@ -1,7 +1,8 @@
 import base64
 import json
 from imghdr import what
-from typing import Callable, Tuple
+from itertools import islice
+from typing import Callable, Iterable, Iterator, Tuple
 from uuid import uuid4
 
 from django.contrib.auth.models import User
@@ -20,6 +21,12 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
 def get_profile_image(user: User) -> str | None:
     return user.profile.image.url if user.profile.image else None
 
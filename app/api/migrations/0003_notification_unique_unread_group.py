@@ -0,0 +1,28 @@
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef
+
+
+def read_duplicate_groups(apps, schema_editor):
+    Notification = apps.get_model('api', 'Notification')
+    newer = Notification.objects.filter(
+        user=OuterRef('user'), group_key=OuterRef('group_key'), read=False, id__gt=OuterRef('id'))
+    Notification.objects.filter(read=False, group_key__isnull=False).filter(Exists(newer)).update(read=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_notification_actor_count_notification_group_key_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(read_duplicate_groups, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='notification',
+            name='notification_group_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(condition=models.Q(('group_key__isnull', False), ('read', False)), fields=('user', 'group_key'), name='unique_unread_group'),
+        ),
+    ]
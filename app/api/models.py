@@ -1,6 +1,13 @@
+import threading
+import time
+from datetime import timedelta
+
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
+from django_redis import get_redis_connection
+
+from api.helper import Singleton
 
 
 class SingletonModel(models.Model):
@@ -51,10 +58,79 @@ class ChainProfile(models.Model):
     def get_reward(self, action: str) -> int:
         return self.to_dict()[action]
 
+    def save(self, *args, **kwargs):
+        super(ChainProfile, self).save(*args, **kwargs)
+        ChainConfigCache.publish()
+
 
 class ChainConfig(SingletonModel):
     profile = models.ForeignKey(ChainProfile, on_delete=models.DO_NOTHING)
 
+    def save(self, *args, **kwargs):
+        super(ChainConfig, self).save(*args, **kwargs)
+        ChainConfigCache.publish()
+
+
+# Every process keeps the chain config and its reward table in memory.
+# Saving a ChainConfig or ChainProfile publishes on the chain_config: channel after commit,
+# a listener thread in every process drops its copy then. Copies also expire after ttl seconds
+# in case a message was missed while the listener reconnected.
+class ChainConfigCache(metaclass=Singleton):
+    channel: str = "chain_config:"
+    ttl: float = 300
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.config: ChainConfig | None = None
+        self.rewards: dict[str, int] = dict()
+        self.loaded_at: float = 0
+        self.generation: int = 0
+        self.listener: threading.Thread | None = None
+
+    @classmethod
+    def publish(cls) -> None:
+        transaction.on_commit(lambda: get_redis_connection().publish(cls.channel, "1"))
+
+    # Started lazily so that forked workers start their own, a new listener may have missed messages
+    def listen(self) -> None:
+        if self.listener is not None and self.listener.is_alive():
+            return
+        with self.lock:
+            if self.listener is not None and self.listener.is_alive():
+                return
+            pubsub = get_redis_connection().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: lambda message: self.invalidate()})
+            self.listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+            self.generation += 1
+            self.config = None
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.config = None
+
+    # A config loaded while an invalidation arrived is used once but not kept
+    def get(self) -> ChainConfig:
+        self.listen()
+        config: ChainConfig | None = self.config
+        if config is not None and time.monotonic() - self.loaded_at < self.ttl:
+            return config
+
+        generation: int = self.generation
+        config = ChainConfig.objects.select_related("profile").get(pk=1)
+        rewards: dict[str, int] = config.profile.to_dict()
+        with self.lock:
+            if generation == self.generation:
+                self.config, self.rewards, self.loaded_at = config, rewards, time.monotonic()
+        return config
+
+    def profile(self) -> ChainProfile:
+        return self.get().profile
+
+    def reward(self, action: str) -> int:
+        config: ChainConfig = self.get()
+        return self.rewards[action] if config is self.config else config.profile.get_reward(action)
+
 
 class Notification(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -63,6 +139,126 @@ class Notification(models.Model):
     show_on_profile = models.BooleanField(default=False)
     date_created = models.DateTimeField(default=timezone.now)
     item_id = models.CharField(null=True, blank=True, max_length=100)
+    # unread notifications of the same event on the same item collapse into one of group_key
+    group_key = models.CharField(null=True, blank=True, max_length=100)
+    actor_count = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "show_on_profile", "-id"], name="notification_inbox_idx"),
+            models.Index(fields=["date_created"], name="notification_archive_idx",
+                         condition=models.Q(read=True)),
+        ]
+        # a group has at most one unread notification, concurrent engagements can't both insert one
+        constraints = [
+            models.UniqueConstraint(fields=["user", "group_key"], name="unique_unread_group",
+                                    condition=models.Q(read=False, group_key__isnull=False)),
+        ]
 
     def __str__(self) -> str:
         return f"to: {self.user.username}"
+
+    # Inbox page of the notifications older than before, newest first
+    @classmethod
+    def inbox(cls, user_id: int, show_on_profile: bool, before: int | None, limit: int) -> list["Notification"]:
+        notifications = cls.objects.filter(user_id=user_id, show_on_profile=show_on_profile)
+        if before is not None:
+            notifications = notifications.filter(id__lt=before)
+        return list(notifications.order_by("-id")[:limit])
+
+    # Moves read notifications older than older_than to ArchivedNotification chunk_size rows per transaction
+    @classmethod
+    def archive(cls, older_than: timedelta = timedelta(days=30), chunk_size: int = 1000) -> int:
+        cutoff = timezone.now() - older_than
+        archived: int = 0
+        while True:
+            with transaction.atomic():
+                notifications: list[Notification] = list(
+                    cls.objects.select_for_update(skip_locked=True)
+                    .filter(read=True, date_created__lt=cutoff).order_by("date_created")[:chunk_size])
+                if not notifications:
+                    return archived
+                ArchivedNotification.objects.bulk_create([
+                    ArchivedNotification(
+                        id=notification.id,
+                        user_id=notification.user_id,
+                        data=notification.data,
+                        show_on_profile=notification.show_on_profile,
+                        date_created=notification.date_created,
+                        item_id=notification.item_id
+                    ) for notification in notifications
+                ], ignore_conflicts=True)
+                cls.objects.filter(id__in=[notification.id for notification in notifications]).delete()
+            archived += len(notifications)
+
+
+# Cold storage of read notifications, nothing reads it on the request path
+class ArchivedNotification(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    data = models.JSONField()
+    show_on_profile = models.BooleanField(default=False)
+    date_created = models.DateTimeField()
+    item_id = models.CharField(null=True, blank=True, max_length=100)
+    date_archived = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "-id"], name="archived_notification_user_idx"),
+        ]
+
+
+# KEYS: unread:<user>  ARGV: category, step
+# Moves a counter only while the hash exists, a missing hash is counted from the table on the next read
+UNREAD_INCREMENT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+end
+return nil
+"""
+
+
+# Unread notifications per user in the hash unread:<user>, profile notifications are counted under
+# "profile" and the rest under "message". Counters expire after ttl and are counted again,
+# which also settles drift from a notification created while its hash was being counted.
+class UnreadCounter(metaclass=Singleton):
+    cache = get_redis_connection()
+    increment_script = cache.register_script(UNREAD_INCREMENT_SCRIPT)
+    ttl: int = 24 * 60 * 60
+
+    @staticmethod
+    def key(user_id: int) -> str:
+        return f"unread:{user_id}"
+
+    @staticmethod
+    def category(show_on_profile: bool) -> str:
+        return "profile" if show_on_profile else "message"
+
+    def add(self, user_ids: list[int], show_on_profile: bool, step: int = 1) -> None:
+        pipeline = self.cache.pipeline(transaction=False)
+        for user_id in user_ids:
+            self.increment_script(
+                keys=[self.key(user_id)], args=[self.category(show_on_profile), step], client=pipeline)
+        pipeline.execute()
+
+    def get(self, user_id: int) -> dict[str, int]:
+        counts: dict = self.cache.hgetall(self.key(user_id))
+        if not counts:
+            counts = {"profile": 0, "message": 0}
+            for show_on_profile, count in Notification.objects.filter(user_id=user_id, read=False) \
+                    .values_list("show_on_profile").annotate(count=models.Count("id")).order_by():
+                counts[self.category(show_on_profile)] = count
+            self.cache.hset(self.key(user_id), mapping=counts)
+            self.cache.expire(self.key(user_id), self.ttl)
+        return {category.decode() if isinstance(category, bytes) else category: max(int(count), 0)
+                for category, count in counts.items()}
+
+    # Marks the user's unread notifications of one category read in one UPDATE, only those in ids if given
+    def mark_read(self, user_id: int, show_on_profile: bool, ids: list[int] | None = None) -> int:
+        notifications = Notification.objects.filter(user_id=user_id, show_on_profile=show_on_profile, read=False)
+        if ids is not None:
+            notifications = notifications.filter(id__in=ids)
+        updated: int = notifications.update(read=True)
+        if updated:
+            self.add([user_id], show_on_profile, -updated)
+        return updated
@@ -1,29 +1,50 @@
 from datetime import datetime
 import json
 from decimal import Decimal
+from typing import Iterable
 
-from firebase_admin.messaging import Message
+from firebase_admin.messaging import MulticastMessage, UnregisteredError, send_multicast
 from fcm_django.models import FCMDevice
 from django.contrib.auth.models import User
-from api.helper import get_profile_image
-from api.models import Notification
+from django.db import IntegrityError, transaction
+from django_redis import get_redis_connection
+from api.helper import chunked, get_profile_image
+from api.models import Notification, UnreadCounter
 from django.db.models import QuerySet
 
+# FCM takes at most this many tokens in one multicast message
+MULTICAST_LIMIT = 500
+CREATE_BATCH_SIZE = 1000
 
-def notification(
-        to: User,
-        category: str = "social",
-        notification_type: str = None,
-        action: str = None,
-        item_id: int = None,
-        image_url: str = None,
-        save_to_profile: bool = False) -> None:
 
-    devices: QuerySet[FCMDevice] = FCMDevice.objects.filter(user=to)
-    last_notification: Notification = Notification.objects.last()
-    last_id = 0
-    if last_notification:
-        last_id = last_notification.id
+class FCMTransport:
+    # Returns the tokens FCM doesn't know anymore
+    @staticmethod
+    def send(tokens: list[str], data: dict[str, str]) -> list[str]:
+        response = send_multicast(MulticastMessage(tokens=tokens, data=data))
+        return [
+            token for token, result in zip(tokens, response.responses)
+            if not result.success and isinstance(result.exception, UnregisteredError)
+        ]
+
+
+# Keeps the messages instead of sending them, for tests and development without FCM
+class LocalTransport:
+    def __init__(self) -> None:
+        self.sent: list[tuple[list[str], dict[str, str]]] = []
+
+    def send(self, tokens: list[str], data: dict[str, str]) -> list[str]:
+        self.sent.append((tokens, data))
+        return []
+
+
+# The id tells notifications apart on the device, one fan-out shares it since every recipient is another user
+def notification_data(
+        category: str,
+        notification_type: str | None,
+        action: str | None,
+        item_id: int | None,
+        image_url: str | None) -> dict[str, str]:
     data: dict[str, str] = {
         'type': notification_type,
         'content': json.dumps({
@@ -33,23 +54,104 @@ def notification(
             "groupKey": f"{category}_group",
             "category": category,
             'body': action,
-            "id": last_id + 1,
+            "id": get_redis_connection().incr("notification_id:"),
         }),
         'time': str(datetime.now())
     }
     if item_id:
         data['item_id'] = str(item_id)
-    for device in devices:
-        device.send_message(Message(data=data))
-        print(device.device_id)
-    Notification.objects.create(
-        data=data,
-        user=to,
-        show_on_profile=save_to_profile,
-        item_id=str(item_id) if item_id else None
+    return data
+
+
+# Inserts one notification for every user in user_ids, the unread counters and devices are left to the caller
+def store_notifications(
+        user_ids: list[int],
+        data: dict[str, str],
+        item_id: int = None,
+        save_to_profile: bool = False,
+        group_key: str | None = None,
+        actor_count: int = 1) -> None:
+    Notification.objects.bulk_create([
+        Notification(
+            data=data,
+            user_id=user_id,
+            show_on_profile=save_to_profile,
+            item_id=str(item_id) if item_id else None,
+            group_key=group_key,
+            actor_count=actor_count
+        ) for user_id in user_ids
+    ])
+
+
+# Messages the active devices of recipients MULTICAST_LIMIT tokens at a time and deactivates unregistered ones
+def deliver(
+        recipients: list[int] | QuerySet,
+        data: dict[str, str],
+        transport: FCMTransport | LocalTransport) -> None:
+    devices: QuerySet = FCMDevice.objects.filter(
+        user_id__in=recipients, active=True
+    ).values_list("registration_id", flat=True)
+    unregistered: list[str] = []
+    for tokens in chunked(devices.iterator(), MULTICAST_LIMIT):
+        unregistered += transport.send(tokens, data)
+    if unregistered:
+        FCMDevice.objects.filter(registration_id__in=unregistered).update(active=False)
+
+
+# Sends one notification to every user in recipients, a list of ids or a queryset of ids.
+# Notifications are inserted CREATE_BATCH_SIZE at a time, devices are read in one query
+# and messaged MULTICAST_LIMIT tokens at a time.
+def fan_out(
+        recipients: Iterable[int] | QuerySet,
+        category: str = "social",
+        notification_type: str = None,
+        action: str = None,
+        item_id: int = None,
+        image_url: str = None,
+        save_to_profile: bool = False,
+        transport: FCMTransport | LocalTransport | None = None,
+        group_key: str | None = None,
+        actor_count: int = 1) -> int:
+    transport = transport if transport is not None else FCMTransport()
+    data: dict[str, str] = notification_data(category, notification_type, action, item_id, image_url)
+    is_query: bool = isinstance(recipients, QuerySet)
+    if not is_query:
+        recipients = list(recipients)
+
+    created: int = 0
+    user_ids = recipients.iterator() if is_query else recipients
+    for chunk in chunked(user_ids, CREATE_BATCH_SIZE):
+        store_notifications(chunk, data, item_id, save_to_profile, group_key, actor_count)
+        UnreadCounter().add(chunk, save_to_profile)
+        created += len(chunk)
+
+    deliver(recipients, data, transport)
+    return created
+
+
+def notification(
+        to: User,
+        category: str = "social",
+        notification_type: str = None,
+        action: str = None,
+        item_id: int = None,
+        image_url: str = None,
+        save_to_profile: bool = False) -> None:
+    fan_out(
+        [to.id],
+        category=category,
+        notification_type=notification_type,
+        action=action,
+        item_id=item_id,
+        image_url=image_url,
+        save_to_profile=save_to_profile
     )
 
 
+# Repeats of these on the same item collapse into one unread notification
+COLLAPSED_ACTIONS = frozenset({"LIKE", "COMMENT", "LIKE_COMMENT", "JOIN", "CONTRIBUTE", "ATTEND"})
+
+
 def engage_notification(
         to: User,
         sender: User,
@@ -59,36 +161,79 @@ def engage_notification(
     action_str: str
     match action.upper():
         case 'LIKE':
-            action_str = f'{sender.username} liked your post'
+            action_str = 'liked your post'
         case 'COMMENT':
-            action_str = f'{sender.username} commented on your post'
+            action_str = 'commented on your post'
         case "LIKE_COMMENT":
-            action_str = f'{sender.username} liked your comment'
+            action_str = 'liked your comment'
         case "FOLLOW":
-            action_str = f'{sender.username} followed you'
+            action_str = 'followed you'
         case "FOLLOW_REQUEST":
-            action_str = f'{sender.username} wants to follow you'
+            action_str = 'wants to follow you'
         case "JOIN":
-            action_str = f'{sender.username} joined your community'
+            action_str = 'joined your community'
         case "CONTRIBUTE":
-            action_str = f'{sender.username} is contributing to your post'
+            action_str = 'is contributing to your post'
         case "ATTEND":
-            action_str = f'{sender.username} is attending your event'
+            action_str = 'is attending your event'
         case _:
             raise Exception(f'Action is not valid: {action}')
-    notification(
-        to=to,
-        notification_type=action.lower(),
-        item_id=item_id,
-        image_url=image,
-        action=action_str,
-        save_to_profile=True
-    )
+    if action.upper() not in COLLAPSED_ACTIONS:
+        notification(
+            to=to,
+            notification_type=action.lower(),
+            item_id=item_id,
+            image_url=image,
+            action=f'{sender.username} {action_str}',
+            save_to_profile=True
+        )
+        return
 
+    # The unread notification of the group is replaced by a new one, so it moves to the top of the inbox.
+    # Only the swap happens under the row lock, Redis and FCM are touched once it is committed
+    # so a rollback leaves neither a wrong counter nor a sent push behind.
+    group_key: str = f"{action.lower()}:{item_id}"
+    for attempt in range(3):
+        try:
+            with transaction.atomic():
+                collapse_notification(to, sender, action, action_str, item_id, image, group_key)
+            return
+        except IntegrityError:
+            # a concurrent engagement inserted the group's row first, the next attempt merges into it
+            continue
+    print(f"Notification {group_key} for {to.id} not collapsed")
 
-def text_notification(
+
+def collapse_notification(
         to: User,
         sender: User,
+        action: str,
+        action_str: str,
+        item_id: int,
+        image: str | None,
+        group_key: str) -> None:
+    previous: Notification | None = Notification.objects.select_for_update().filter(
+        user=to, group_key=group_key, read=False).first()
+    actor_count: int = previous.actor_count + 1 if previous is not None else 1
+    if previous is not None:
+        previous.delete()
+    others: str = f" and {actor_count - 1} {'other' if actor_count == 2 else 'others'}" if actor_count > 1 else ""
+    data: dict[str, str] = notification_data(
+        "social", action.lower(), f'{sender.username}{others} {action_str}', item_id, image)
+    store_notifications([to.id], data, item_id, True, group_key, actor_count)
+
+    def on_commit() -> None:
+        if previous is not None:
+            UnreadCounter().add([to.id], previous.show_on_profile, -1)
+        UnreadCounter().add([to.id], True)
+        deliver([to.id], data, FCMTransport())
+
+    transaction.on_commit(on_commit)
+
+
+def text_notification(
+        to: list[int],
+        sender: User,
         message_data: str,
         message_type: str) -> None:
     image = get_profile_image(sender)
@@ -106,8 +251,8 @@ def text_notification(
             action_str = f'{sender.username}: Community'
         case _:
             raise Exception(f'Invalid type: {message_type}')
-    notification(
-        to=to,
+    fan_out(
+        to,
         notification_type="message",
         image_url=image,
         action=action_str,
@@ -151,13 +296,18 @@ def token_notification(
     )
 
 
-def new_post_notification(to: User, sender: User, post_id: int, post_title: str) -> None:
+def new_post_notification(
+        sender: User,
+        post_id: int,
+        post_title: str,
+        transport: FCMTransport | LocalTransport | None = None) -> int:
     action_str = f"{sender.username} just published a new post: {post_title}"
     image = get_profile_image(sender)
-    notification(
-        to=to,
+    return fan_out(
+        sender.profile.get_followers().values_list("follower_id", flat=True),
         notification_type="follower_post",
         image_url=image,
         action=action_str,
-        item_id=post_id
+        item_id=post_id,
+        transport=transport
     )
@@ -4,30 +4,51 @@ from celery import shared_task
 from api.notifications import *
 from api.models import *
 
+# Tasks take primary keys and load what they need, every task here runs on the notifications queue
+
+
+@shared_task
+def send_text_notification(to_ids: list[int], sender_id: int, message_data: str, message_type: str) -> None:
+    text_notification(to_ids, User.objects.select_related("profile").get(id=sender_id), message_data, message_type)
+
 
 @shared_task
-def send_text_notification(to: User, sender: User, message_data: str, message_type: str) -> None:
-    text_notification(to, sender, message_data, message_type)
+def send_level_up_notification(to_id: int) -> None:
+    level_up_notification(User.objects.select_related("chainpage").get(id=to_id))
 
 
 @shared_task
-def send_level_up_notification(to: User) -> None:
-    level_up_notification(to)
+def send_token_notification(to_id: int, action: str, sender_id: int = None, amount: str = None) -> None:
+    token_notification(
+        to=User.objects.get(id=to_id),
+        action=action,
+        sender=User.objects.select_related("profile").get(id=sender_id) if sender_id else None,
+        amount=Decimal(amount) if amount is not None else None
+    )
 
 
 @shared_task
-def send_token_notification(to: User, action: str, sender: User = None, amount: Decimal = None) -> None:
-    token_notification(to=to, action=action, sender=sender, amount=amount)
+def send_new_post_notification(sender_id: int, post_id: int, post_title: str) -> None:
+    sent: int = new_post_notification(User.objects.get(id=sender_id), post_id, post_title)
+    print(f"{sent} followers notified of post {post_id}.")
 
 
 @shared_task
-def send_new_post_notification(to: User, sender: User, post_id: int, post_title: str) -> None:
-    new_post_notification(to, sender, post_id, post_title)
+def send_engage_notification(to_id: int, sender_id: int, action: str, item_id: int) -> None:
+    users: dict[int, User] = User.objects.select_related("profile").in_bulk([to_id, sender_id])
+    engage_notification(users[to_id], users[sender_id], action, item_id)
 
 
 @shared_task
-def reward_and_notify(owner: User, user: User, action: str, item_id: int):
-    if owner == user:
+def reward_and_notify(owner_id: int, user_id: int, action: str, item_id: int):
+    if owner_id == user_id:
         return
-    owner.chainpage.get_reward(action)
-    engage_notification(owner, user, action, item_id)
+    users: dict[int, User] = User.objects.select_related("profile", "chainpage").in_bulk([owner_id, user_id])
+    users[owner_id].chainpage.get_reward(action)
+    engage_notification(users[owner_id], users[user_id], action, item_id)
+
+
+@shared_task(name="archive_notifications")
+def archive_notifications():
+    archived: int = Notification.archive()
+    print(f"{archived} notifications archived.")
@@ -0,0 +1,49 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from fcm_django.models import FCMDevice
+
+from api import notifications
+from api.models import Notification, UnreadCounter
+from api.notifications import LocalTransport, fan_out
+
+
+class FanOutTestCase(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f"user{i}", password="rrrrrrrr") for i in range(5)]
+        for i, user in enumerate(self.users[:4]):
+            FCMDevice.objects.create(user=user, registration_id=f"token{i}", type="android", active=i != 3)
+
+    def test_one_notification_per_recipient(self):
+        transport = LocalTransport()
+        created = fan_out([user.id for user in self.users], action="hello", transport=transport)
+        self.assertEqual(created, 5)
+        self.assertEqual(Notification.objects.filter(user__in=self.users).count(), 5)
+        self.assertEqual(sorted(token for tokens, _ in transport.sent for token in tokens),
+                         ["token0", "token1", "token2"])
+
+    def test_devices_are_sent_in_multicast_chunks(self):
+        transport = LocalTransport()
+        limit, notifications.MULTICAST_LIMIT = notifications.MULTICAST_LIMIT, 2
+        try:
+            fan_out(User.objects.values_list("id", flat=True), action="hello", transport=transport)
+        finally:
+            notifications.MULTICAST_LIMIT = limit
+        self.assertEqual([len(tokens) for tokens, _ in transport.sent], [2, 1])
+        self.assertEqual(len({data["content"] for _, data in transport.sent}), 1)
+
+
+class UnreadCounterTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="reader", password="rrrrrrrr")
+        UnreadCounter().cache.delete(UnreadCounter.key(self.user.id))
+
+    def test_counts_follow_fan_out_and_reads(self):
+        fan_out([self.user.id], action="old", save_to_profile=True, transport=LocalTransport())
+        self.assertEqual(UnreadCounter().get(self.user.id), {"profile": 1, "message": 0})
+        fan_out([self.user.id], action="new", save_to_profile=True, transport=LocalTransport())
+        fan_out([self.user.id], action="text", transport=LocalTransport())
+        self.assertEqual(UnreadCounter().get(self.user.id), {"profile": 2, "message": 1})
+
+        self.assertEqual(UnreadCounter().mark_read(self.user.id, show_on_profile=True), 2)
+        self.assertEqual(UnreadCounter().mark_read(self.user.id, show_on_profile=True), 0)
+        self.assertEqual(UnreadCounter().get(self.user.id), {"profile": 0, "message": 1})
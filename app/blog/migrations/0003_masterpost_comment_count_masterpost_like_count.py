@@ -0,0 +1,40 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_likes_and_comments(apps, schema_editor):
+    MasterPost = apps.get_model('blog', 'MasterPost')
+    Comment = apps.get_model('blog', 'Comment')
+    UserPostRelation = apps.get_model('recommender', 'UserPostRelation')
+
+    likes = UserPostRelation.objects.filter(post=OuterRef('pk'), is_liked=True) \
+        .order_by().values('post').annotate(count=Count('id')).values('count')
+    comments = Comment.objects.filter(post=OuterRef('pk')) \
+        .order_by().values('post').annotate(count=Count('id')).values('count')
+    MasterPost.objects.update(
+        like_count=Coalesce(Subquery(likes), 0),
+        comment_count=Coalesce(Subquery(comments), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0002_initial'),
+        ('recommender', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='masterpost',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='masterpost',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_likes_and_comments, migrations.RunPython.noop),
+    ]
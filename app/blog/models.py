@@ -3,19 +3,20 @@ from location_field.models.plain import PlainLocationField
 from geopy.geocoders import Nominatim
 from datetime import datetime, timedelta
 from django.core.validators import FileExtensionValidator
-from django.db import models
+from django.db import models, transaction
 from django.db.models.deletion import SET_NULL
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.utils.translation import gettext_lazy as _
 from eth_account import Account
-from django.db.models import QuerySet
+from django.db.models import Count, F, OuterRef, Q, QuerySet, Subquery
+from django.db.models.functions import Coalesce
 from api.dynamic_links import DynamicLinkManager
 
-from recommender.models import RoledUser, UserPostRelation
+from recommender.models import Follow, RoledUser, UserPostRelation
 from subjects.exceptions import InsufficientPrivilege, DontHavePrivilege
 from api.helper import compress_image, get_profile_image
-from chain.level import ChainManager
+from chain.level import BalanceCache, ChainAttributes, ChainManager
 
 
 class PostImage(models.Model):
@@ -71,6 +72,10 @@ class MasterPost(models.Model):
 
     date_posted = models.DateTimeField(default=timezone.now)
 
+    # Denormalized counts of likes and comments, moved with F() increments and reconciled periodically
+    like_count = models.PositiveIntegerField(default=0)
+    comment_count = models.PositiveIntegerField(default=0)
+
     def __check_community_privilege(self) -> None:
         try:
             rolled_user: RoledUser = RoledUser.objects.get(
@@ -100,6 +105,25 @@ class MasterPost(models.Model):
         self.__update_location()
         super(MasterPost, self).save(*args, **kwargs)
 
+    # Followees and communities are subqueries, the database resolves them within the posts query itself
+    @classmethod
+    def visible_to(cls, user: User) -> Q:
+        public: Q = Q(privacy=cls.Privacy.PUBLIC)
+        if user.is_anonymous:
+            return public
+        followees = Follow.objects.filter(
+            follower=user,
+            follow_status=Follow.Status.FOLLOWING
+        ).values("followee_id")
+        communities = RoledUser.objects.filter(
+            user=user,
+            privilege__gte=RoledUser.Roles.member,
+            is_banned=False
+        ).values("community_id")
+        return public | Q(author=user) \
+            | Q(privacy=cls.Privacy.FOLLOWERS, author_id__in=followees) \
+            | Q(privacy=cls.Privacy.COMMUNITY, community_id__in=communities)
+
     def get_comments(self) -> QuerySet['Comment']:
         return Comment.objects.filter(post=self)
 
@@ -116,15 +140,43 @@ class MasterPost(models.Model):
         if UserPostRelation.objects.filter(user=user, post=self).exists():
             UserPostRelation.objects.get(user=user, post=self).toggle_like()
         else:
-            UserPostRelation.objects.create(user=user, post=self, is_liked=True)
+            with transaction.atomic():
+                UserPostRelation.objects.create(user=user, post=self, is_liked=True)
+                MasterPost.move_counter(self.id, "like_count", 1)
         return True
 
+    # Decrements never take a counter below zero, the reconciliation fixes whatever that hides
+    @classmethod
+    def move_counter(cls, post_id: int, counter: str, step: int) -> None:
+        posts: QuerySet[MasterPost] = MasterPost.objects.filter(id=post_id)
+        if step < 0:
+            posts = posts.filter(**{f"{counter}__gte": -step})
+        posts.update(**{counter: F(counter) + step})
+
+    # Recounts likes and comments a chunk of posts at a time and fixes the counters that drifted.
+    # The counts are taken by the UPDATE itself, so a move_counter landing meanwhile isn't overwritten.
+    @classmethod
+    def reconcile_counters(cls, chunk_size: int = 1000) -> int:
+        likes = Coalesce(Subquery(
+            UserPostRelation.objects.filter(post=OuterRef("pk"), is_liked=True)
+            .order_by().values("post").annotate(count=Count("id")).values("count")), 0)
+        comments = Coalesce(Subquery(
+            Comment.objects.filter(post=OuterRef("pk"))
+            .order_by().values("post").annotate(count=Count("id")).values("count")), 0)
+        fixed: int = 0
+        last_id: int = 0
+        while ids := list(cls.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:chunk_size]):
+            last_id = ids[-1]
+            fixed += cls.objects.filter(id__in=ids).exclude(like_count=likes, comment_count=comments) \
+                .update(like_count=likes, comment_count=comments)
+        return fixed
+
     def to_dict(self) -> dict[str: str | int] | None:
         return {
             'title': self.title,
             'id': self.id,
-            'likes': self.get_likes().count(),
-            'comments': self.get_comments().count(),
+            'likes': self.like_count,
+            'comments': self.comment_count,
             'author': self.author.username,
             'author_image': get_profile_image(self.author),
             'type': self.post_type,
@@ -232,8 +284,9 @@ class FundablePost(MasterPost):
             self.address, amount
         )
 
-        attributes = self.chain_manager.chain_attributes(self.address)
-        self.current = int(attributes.balance)
+        attributes: ChainAttributes = BalanceCache().get(self.address)
+        if attributes.balance is not None:
+            self.current = int(attributes.balance)
         self.total_funded += amount / self.chain_manager.exp_decimals()
         self.save()
         return attributes
@@ -242,15 +295,11 @@ class FundablePost(MasterPost):
         if not self.can_retrieve(user=user):
             raise Exception("Can't retrieve. User is not the post author.")
 
-        self.chain_manager.send(
-            ChainManager.Functions.SEND_TOKEN,
-            self.address,
-            user.chainpage.wallet_address,
-            self.chain_manager.call("balanceOf", self.address)
-        )
+        self.chain_manager.sweep(self.address, user.chainpage.wallet_address)
 
-        attributes = self.chain_manager.chain_attributes(self.address)
-        self.current = int(attributes.balance)
+        attributes: ChainAttributes = BalanceCache().get(self.address)
+        if attributes.balance is not None:
+            self.current = int(attributes.balance)
         self.save()
         return attributes
 
@@ -297,7 +346,11 @@ class Comment(models.Model):
                 CommentLike.objects.create(comment=self, user=user)
 
     def save(self, *args, **kwargs):
-        super(Comment, self).save(*args, **kwargs)
+        if not self._state.adding:
+            return super(Comment, self).save(*args, **kwargs)
+        with transaction.atomic():
+            super(Comment, self).save(*args, **kwargs)
+            MasterPost.move_counter(self.post_id, "comment_count", 1)
 
 
 class FormResponse(models.Model):
@@ -1,24 +1,43 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from typing import Iterable
 from datetime import datetime
+import json
 
-from django.db.models import QuerySet
-from django.contrib.auth.models import User
+from django.core.paginator import Paginator
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
+from recommender.feed import Feed
 from recommender.recommend import Recommender
 from blog.models import MasterPost
 
 
 class MasterPostPagination(PageNumberPagination):
     page_size = 10
+    # the materialized feed ranks every post, narrowed listings are recommended per request
+    feed_excluded_params = ("community", "search", "post_type", "author")
+    # Requests carrying this parameter (empty for the first page) are paginated by keyset instead of page number
+    cursor_query_param = "cursor"
+    # bounds the reads spent skipping feed entries hidden from the viewer
+    feed_batches = 4
 
     def __init__(self):
         self.post_score: dict | None = None
         self.recommender: Recommender = Recommender()
+        self.cursor_links: dict | None = None
 
     def get_paginated_response(self, data) -> Response:
+        if self.cursor_links is not None:
+            return Response({
+                'links': self.cursor_links,
+                'has_next': self.cursor_links['next'] is not None,
+                'count': None,
+                'results': data
+            })
         return Response({
             'links': {
                 'next': self.get_next_link(),
@@ -38,26 +57,32 @@ class MasterPostPagination(PageNumberPagination):
             return recommender.get_recommended_posts(request.user, posts)
         return posts
 
+    # One privacy condition for the whole queryset, pages are cut after filtering and stay full
     @staticmethod
-    def __filter_posts(posts: list[MasterPost], request: Request) -> list[MasterPost]:
-        user: User = request.user
-        print(posts)
-        for i in range(len(posts)):
-            post: MasterPost = posts[i]
-            match post.privacy:
-                case MasterPost.Privacy.FOLLOWERS:
-                    if user.is_anonymous or not user.profile.is_following(post.author):
-                        posts.remove(post)
-                        i -= 1
-                    continue
-                case MasterPost.Privacy.COMMUNITY:
-                    if user.is_anonymous or not post.community.is_joined(user):
-                        posts.remove(post)
-                        i -= 1
-                    continue
-                case _:
-                    continue
-        return posts
+    def __filter_posts(posts: QuerySet[MasterPost], request: Request) -> QuerySet[MasterPost]:
+        return posts.filter(MasterPost.visible_to(request.user))
+
+    def __uses_feed(self, request: Request, posts: QuerySet[MasterPost]) -> bool:
+        return not request.user.is_anonymous and posts.model is MasterPost \
+            and not any(param in request.query_params for param in self.feed_excluded_params)
+
+    # Pages are cut from the feed entries the viewer may see, so they stay full.
+    # A feed holds at most Feed.size entries, their visibility is one query on the ids.
+    def __feed_page(self, request: Request, posts: QuerySet[MasterPost]) -> list[MasterPost] | None:
+        feed: Feed = Feed()
+        page_number = request.query_params.get(self.page_query_param, 1)
+        if str(page_number) == "1":
+            feed.prepare(request.user)
+        ids: list[int] = feed.slice(request.user, 0, feed.size)
+        visible: set[int] = set(posts.filter(id__in=ids).values_list("id", flat=True))
+        ids = [post_id for post_id in ids if post_id in visible]
+        if not ids:
+            return None
+
+        self.request = request
+        self.page = Paginator(ids, self.page_size).get_page(page_number)
+        found: dict[int, MasterPost] = posts.in_bulk(self.page.object_list)
+        return [found[post_id] for post_id in self.page.object_list if post_id in found]
 
     def __sort_posts(
             self,
@@ -65,27 +90,154 @@ class MasterPostPagination(PageNumberPagination):
             sort_type: str = "recommender",
             posts: QuerySet[MasterPost],
             request: Request) -> list[MasterPost]:
-        paginated = super().paginate_queryset(posts, request, None)
+        if sort_type == "recommender" and self.__uses_feed(request, posts):
+            page: list[MasterPost] | None = self.__feed_page(request, posts)
+            if page is not None:
+                return page
+
         match sort_type:
             case "recommender":
                 return super().paginate_queryset(
                     self.__recommend_sort(request, posts), request, None)
             case "date":
-                return paginated
+                return super().paginate_queryset(posts, request, None)
             case _:
                 raise Exception(f"Type not expected: {sort_type}")
 
+    @staticmethod
+    def encode_cursor(cursor: dict) -> str:
+        return urlsafe_b64encode(json.dumps(cursor, separators=(",", ":")).encode()).decode()
+
+    # Feed cursors carry a numeric rank in k, the others an ISO date
+    @staticmethod
+    def decode_cursor(encoded: str) -> dict:
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode()))
+            if isinstance(cursor, dict) and {"k", "i", "f"} <= cursor.keys() \
+                    and type(cursor["i"]) is int and cursor["f"] in (0, 1):
+                if cursor["f"] and type(cursor["k"]) in (int, float):
+                    return cursor
+                if not cursor["f"] and isinstance(cursor["k"], str):
+                    datetime.fromisoformat(cursor["k"])
+                    return cursor
+        except (ValueError, TypeError):
+            pass
+        raise NotFound("Invalid cursor")
+
+    def __cursor_link(self, request: Request, cursor: dict, position: tuple, reverse: bool) -> str:
+        encoded: str = self.encode_cursor({"k": position[0], "i": position[1], "f": cursor["f"], "r": int(reverse)})
+        return replace_query_param(
+            remove_query_param(request.build_absolute_uri(), self.page_query_param),
+            self.cursor_query_param, encoded)
+
+    # Feed positions are (rank, id) of the feed's sorted set, the others are (date_posted, id)
+    @staticmethod
+    def __keyset_posts(posts: QuerySet[MasterPost], position: tuple | None, reverse: bool, count: int) \
+            -> list[MasterPost]:
+        if position is None:
+            return list(posts.order_by("-date_posted", "-id")[:count])
+        date_posted, post_id = datetime.fromisoformat(position[0]), position[1]
+        if reverse:
+            return list(posts.filter(
+                Q(date_posted__gt=date_posted) | Q(date_posted=date_posted, id__gt=post_id)
+            ).order_by("date_posted", "id")[:count])
+        return list(posts.filter(
+            Q(date_posted__lt=date_posted) | Q(date_posted=date_posted, id__lt=post_id)
+        ).order_by("-date_posted", "-id")[:count])
+
+    def __feed_entries(self, request: Request, position: tuple | None, reverse: bool, count: int) \
+            -> list[tuple[int, float]]:
+        feed: Feed = Feed()
+        if position is None:
+            feed.prepare(request.user)
+            return feed.after(request.user, None, count)
+        if reverse:
+            return feed.before(request.user, position, count)
+        return feed.after(request.user, position, count)
+
+    # Feed entries the viewer may not see are skipped, further entries are read to fill the page
+    def __feed_posts(self, request: Request, posts: QuerySet[MasterPost], position: tuple | None, reverse: bool) \
+            -> tuple[list[MasterPost], list[tuple], bool]:
+        page: list[MasterPost] = []
+        positions: list[tuple] = []
+        for _ in range(self.feed_batches):
+            wanted: int = self.page_size + 1 - len(page)
+            entries: list[tuple[int, float]] = self.__feed_entries(request, position, reverse, wanted)
+            found: dict[int, MasterPost] = posts.in_bulk([post_id for post_id, _ in entries])
+            for post_id, rank in entries:
+                if post_id in found:
+                    page.append(found[post_id])
+                    positions.append((rank, post_id))
+            if len(entries) < wanted or len(page) > self.page_size:
+                return page, positions, len(page) > self.page_size
+            position = (entries[-1][1], entries[-1][0])
+        return page, positions, True
+
+    # Keyset pagination needs neither a count nor an offset, every page costs the same however deep it is.
+    # Pages fetch one extra row to learn whether another page follows.
+    def __cursor_page(
+            self,
+            *,
+            sort_type: str = "recommender",
+            posts: QuerySet[MasterPost],
+            request: Request) -> list[MasterPost]:
+        if sort_type not in ("recommender", "date"):
+            raise Exception(f"Type not expected: {sort_type}")
+        encoded: str = request.query_params.get(self.cursor_query_param, "")
+        cursor: dict = self.decode_cursor(encoded) if encoded else {
+            "f": int(sort_type == "recommender" and self.__uses_feed(request, posts))}
+        position: tuple | None = (cursor["k"], cursor["i"]) if encoded else None
+        reverse: bool = bool(cursor.get("r"))
+
+        page: list[MasterPost] = []
+        positions: list[tuple] = []
+        has_more: bool = False
+        if cursor["f"]:
+            page, positions, has_more = self.__feed_posts(request, posts, position, reverse)
+            if not positions and position is None:
+                cursor["f"] = 0
+
+        if cursor["f"]:
+            page, positions = page[:self.page_size], positions[:self.page_size]
+        else:
+            if sort_type == "recommender":
+                posts = self.__recommend_sort(request, posts)
+            page = self.__keyset_posts(posts, position, reverse, self.page_size + 1)
+            has_more = len(page) > self.page_size
+            page = page[:self.page_size]
+            positions = [(post.date_posted.isoformat(), post.id) for post in page]
+
+        if reverse:
+            page.reverse()
+            positions.reverse()
+        first: tuple | None = positions[0] if positions else position
+        last: tuple | None = positions[-1] if positions else position
+        self.cursor_links = {
+            'next': self.__cursor_link(request, cursor, last, False)
+            if last is not None and (has_more or reverse) else None,
+            'previous': self.__cursor_link(request, cursor, first, True)
+            if first is not None and (has_more or not reverse) and position is not None else None
+        }
+        return page
+
     def paginate_queryset(
             self,
             queryset: QuerySet[MasterPost],
             request: Request,
             view=None) -> Iterable[MasterPost]:
         sort_type: str = request.query_params.get("sort", "recommender")
-        return self.__filter_posts(posts=self.__sort_posts(
+        posts: QuerySet[MasterPost] = self.__filter_posts(queryset, request)
+        if self.cursor_query_param in request.query_params:
+            return self.__cursor_page(
+                sort_type=sort_type,
+                posts=posts,
+                request=request
+            )
+        return self.__sort_posts(
             sort_type=sort_type,
-            posts=queryset,
+            posts=posts,
             request=request
-        ), request=request)
+        )
 
 
 class CommentPagination(PageNumberPagination):
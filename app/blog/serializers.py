@@ -1,8 +1,12 @@
+from collections import defaultdict
+from typing import Iterable
+
+from django.db.models import Count, Manager, QuerySet, prefetch_related_objects
 from rest_framework import serializers
 from rest_framework.request import Request
 
 from api.serializers import Base64FileField, Base64ImageField
-from chain.level import ChainManager
+from chain.level import BalanceCache, ChainAttributes
 from blog.models import *
 from subjects.serializers import SmallProfileSerializer, StoryProfileSerializer
 
@@ -23,6 +27,75 @@ class PostVideoSerializer(serializers.ModelSerializer):
         fields = ['id', 'video', 'position']
 
 
+# Everything MasterPostSerializer looks up per post, queried once for a whole page of posts
+class PostBatch:
+    # posts show the first followees who liked them, in the order they liked
+    liked_by_following_limit: int = 3
+
+    @staticmethod
+    def liked_by_following_relations(user: User, post_ids: Iterable[int]) -> QuerySet[UserPostRelation]:
+        followees = Follow.objects.filter(
+            follower=user, follow_status=Follow.Status.FOLLOWING).values("followee_id")
+        return UserPostRelation.objects.filter(
+            post_id__in=post_ids, is_liked=True, user_id__in=followees
+        ).select_related("user__profile").order_by("id")
+
+    def __init__(self, posts: list[MasterPost], user: User) -> None:
+        self.user: User = user
+        self.ids: set[int] = {post.id for post in posts}
+        prefetch_related_objects(posts, "images", "videos", "author__profile", "community")
+        self.events: dict[int, EventPost] = EventPost.objects.annotate(
+            attendee_count=Count("attendies")
+        ).in_bulk([post.id for post in posts if post.post_type == MasterPost.Types.EVENT])
+        self.projects: dict[int, FundablePost] = FundablePost.objects.annotate(
+            contributor_count=Count("contributers")
+        ).in_bulk([post.id for post in posts if post.post_type == MasterPost.Types.PROJECT])
+
+        self.liked: set[int] = set()
+        self.attending: set[int] = set()
+        self.contributing: set[int] = set()
+        self.roles: dict[int, RoledUser] = dict()
+        self.liked_by_following: dict[int, list[User]] = defaultdict(list)
+        self.__balance: ChainAttributes | None = None
+        if user.is_anonymous:
+            return
+        self.liked = set(UserPostRelation.objects.filter(
+            user=user, post_id__in=self.ids, is_liked=True).values_list("post_id", flat=True))
+        self.attending = set(EventPost.objects.filter(
+            id__in=self.events, attendies=user).values_list("id", flat=True))
+        self.contributing = set(FundablePost.objects.filter(
+            id__in=self.projects, contributers=user).values_list("id", flat=True))
+        self.roles = {
+            roled_user.community_id: roled_user for roled_user in RoledUser.objects.filter(
+                user=user, community_id__in={post.community_id for post in posts})
+        }
+        for relation in self.liked_by_following_relations(user, self.ids):
+            if len(self.liked_by_following[relation.post_id]) < self.liked_by_following_limit:
+                self.liked_by_following[relation.post_id].append(relation.user)
+
+    # The viewer's cached balance is the same for every project of the page, it is read once
+    def balance(self) -> ChainAttributes:
+        if self.__balance is None:
+            self.__balance = viewer_balance(self.user)
+        return self.__balance
+
+
+def viewer_balance(user: User) -> ChainAttributes:
+    try:
+        return BalanceCache().get(user.chainpage.wallet_address)
+    except Exception:
+        return ChainAttributes(connected=False, address=None)
+
+
+class MasterPostListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        posts: list[MasterPost] = list(data.all() if isinstance(data, Manager) else data)
+        request: Request | None = self.context.get('request')
+        if request is not None:
+            self.context['post_batch'] = PostBatch(posts, request.user)
+        return super().to_representation(posts)
+
+
 class MasterPostSerializer(serializers.ModelSerializer):
     author_details = serializers.SerializerMethodField()
     community_details = serializers.SerializerMethodField()
@@ -61,6 +134,10 @@ class MasterPostSerializer(serializers.ModelSerializer):
             return query.first().is_liked
         return False
 
+    def batch(self, obj: MasterPost) -> PostBatch | None:
+        batch: PostBatch | None = self.context.get('post_batch')
+        return batch if batch is not None and obj.id in batch.ids else None
+
     @staticmethod
     def get_author_details(obj: MasterPost) -> dict:
         return SmallProfileSerializer(obj.author).data
@@ -69,23 +146,21 @@ class MasterPostSerializer(serializers.ModelSerializer):
         request_user: User = self.context['request'].user
         if request_user.is_anonymous:
             return []
-        following = set([
-            user for user in request_user.profile.get_following()
-        ])
-        liked_by = set([
-            user_post.user for user_post in
-            UserPostRelation.objects.filter(post=obj, is_liked=True)
-        ])
-        liked_by = list(following.intersection(liked_by))[:3]
+        if batch := self.batch(obj):
+            return SmallProfileSerializer(batch.liked_by_following[obj.id], many=True).data
+        liked_by: list[User] = [
+            relation.user for relation in PostBatch.liked_by_following_relations(
+                request_user, [obj.id])[:PostBatch.liked_by_following_limit]
+        ]
         return SmallProfileSerializer(liked_by, many=True).data
 
     @staticmethod
-    def get_comments(obj):
-        return Comment.objects.filter(post=obj).count()
+    def get_comments(obj: MasterPost):
+        return obj.comment_count
 
     @staticmethod
     def get_likes(obj: MasterPost):
-        return UserPostRelation.objects.filter(post=obj, is_liked=True).count()
+        return obj.like_count
 
     @staticmethod
     def get_community_details(obj: MasterPost):
@@ -108,6 +183,8 @@ class MasterPostSerializer(serializers.ModelSerializer):
                 "is_contributing": False,
                 "is_anonymous": True
             }
+        if batch := self.batch(obj):
+            return self.batch_request_details(batch, user, obj)
         allowed_actions = []
         if self.is_author(user, obj): allowed_actions += ['delete', 'update']
         try:
@@ -128,10 +205,29 @@ class MasterPostSerializer(serializers.ModelSerializer):
             "is_anonymous": False
         }
 
+    @staticmethod
+    def batch_request_details(batch: PostBatch, user: User, obj: MasterPost) -> dict:
+        allowed_actions = []
+        if MasterPostSerializer.is_author(user, obj): allowed_actions += ['delete', 'update']
+        roled_user: RoledUser | None = batch.roles.get(obj.community_id)
+        if roled_user is not None and roled_user.can_do("post_d"):
+            allowed_actions.append('remove_from_community')
+        return {
+            "user_details": SmallProfileSerializer(user).data,
+            "image": get_profile_image(user),
+            "allowed_actions": allowed_actions,
+            "is_liked": obj.id in batch.liked,
+            "is_author": MasterPostSerializer.is_author(user, obj),
+            "is_attending": obj.id in batch.attending,
+            "is_contributing": obj.id in batch.contributing,
+            "is_anonymous": False
+        }
+
     def get_event_fields(self, obj: MasterPost) -> dict | None:
         if obj.post_type != MasterPost.Types.EVENT:
             return None
-        event: EventPost = obj.eventpost
+        batch: PostBatch | None = self.batch(obj)
+        event: EventPost = batch.events[obj.id] if batch else obj.eventpost
         return {
             'type': event.type,
             'date': event.date,
@@ -139,39 +235,36 @@ class MasterPostSerializer(serializers.ModelSerializer):
             'location_name': event.location_name,
             'location': event.location,
             'can_attend': event.can_attend(datetime.now(timezone.utc)),
-            'attendees': event.attendies.all().count()
+            'attendees': event.attendee_count if batch else event.attendies.all().count()
         }
 
     def get_project_fields(self, obj: MasterPost) -> dict | None:
         if obj.post_type != MasterPost.Types.PROJECT:
             return None
-        project: FundablePost = obj.fundablepost
-
-        try:
-            current_balance: int | None = ChainManager().chain_attributes(
-                self.context['request'].user.chainpage.wallet_address).balance
-        except Exception as e:
-            current_balance = None
+        batch: PostBatch | None = self.batch(obj)
+        project: FundablePost = batch.projects[obj.id] if batch else obj.fundablepost
+        balance: ChainAttributes = batch.balance() if batch else viewer_balance(self.context['request'].user)
         return {
             'target': float(project.target),
             'minimum': float(project.minimum_fundable_amount)
             if project.minimum_fundable_amount else None,
             'current': float(project.current),
             'address': project.address,
-            'contributors': project.contributers.all().count(),
-            'user_current_balance': str(current_balance) if current_balance is not None else None,
+            'contributors': project.contributor_count if batch else project.contributers.all().count(),
+            'user_current_balance': str(balance.balance) if balance.balance is not None else None,
+            'user_balance_updated': balance.updated,
             'total_funded': float(project.total_funded)
         }
 
-    @staticmethod
-    def get_post_form_data(obj: MasterPost) -> dict | None:
+    def get_post_form_data(self, obj: MasterPost) -> dict | None:
+        batch: PostBatch | None = self.batch(obj)
         if obj.post_type == MasterPost.Types.POST:
             return None
         elif obj.post_type == MasterPost.Types.PROJECT:
-            project: FundablePost = obj.fundablepost
+            project: FundablePost = batch.projects[obj.id] if batch else obj.fundablepost
             return project.form_data
         else:
-            event: EventPost = obj.eventpost
+            event: EventPost = batch.events[obj.id] if batch else obj.eventpost
             return event.form_data
 
     def get_images(self, obj: MasterPost) -> list:
@@ -190,6 +283,7 @@ class MasterPostSerializer(serializers.ModelSerializer):
                   'author_details', 'liked_by_following',
                   'region_details', 'date_posted', 'event_fields',
                   'project_fields', 'post_form_data', 'videos', 'privacy']
+        list_serializer_class = MasterPostListSerializer
 
 
 class EventPostSerializer(MasterPostSerializer):
@@ -1,25 +1,21 @@
-from django.db.models.signals import post_save, pre_delete
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from api.tasks import send_new_post_notification
 
 from blog.models import MasterPost, Comment
 from recommender.models import PostComment
 from recommender.recommend import Recommender
-
-recommender = Recommender()
+from recommender.tasks import fan_out_post
 
 
 @receiver(post_save, sender=MasterPost)
 def send_to_recommender(sender, instance: MasterPost, created, **kwargs):
     if created:
-        recommender.add_post_relation(instance)
-        for follower in instance.author.profile.get_followers():
-            send_new_post_notification(follower.follower, instance.author, instance.id, instance.title)
-
-
-@receiver(pre_delete, sender=MasterPost)
-def delete_from_recommender(sender, instance, **kwargs):
-    recommender.remove_post_relation(instance)
+        transaction.on_commit(lambda: Recommender().queue_post(instance.id))
+        transaction.on_commit(lambda: fan_out_post.delay(instance.id))
+        transaction.on_commit(lambda: send_new_post_notification.delay(
+            instance.author_id, instance.id, instance.title))
 
 
 @receiver(post_save, sender=Comment)
@@ -30,3 +26,8 @@ def on_comment_creation(sender, instance: Comment, created: bool, **kwargs):
         if not post_comment_exists:
             PostComment.objects.create(
                 user=instance.author, post=instance.post, comment=instance)
+
+
+@receiver(post_delete, sender=Comment)
+def on_comment_deletion(sender, instance: Comment, **kwargs):
+    MasterPost.move_counter(instance.post_id, "comment_count", -1)
@@ -0,0 +1,9 @@
+from celery import shared_task
+
+from blog.models import MasterPost
+
+
+@shared_task(name="reconcile_post_counters")
+def reconcile_post_counters():
+    fixed: int = MasterPost.reconcile_counters()
+    print(f"Post counters reconciled: {fixed}")
@@ -37,6 +37,7 @@ from recommender.models import UserPostRelation, Follow
 from subjects.exceptions import InsufficientPrivilege
 from subjects.models import Community
 from api.helper import paginate_queryset
+from chain.exceptions import ImpossibleTransaction, InvalidInput, ZeroAmount
 from subjects.serializers import SmallProfileSerializer
 
 
@@ -203,7 +204,10 @@ class ProjectViewSet(MasterPostViewSet):
                 'error': 'Bad Data'
             }, status=405)
         post: FundablePost = get_object_or_404(FundablePost, pk)
-        data = post.fund_post(user, int(amount))
+        try:
+            data = post.fund_post(user, int(amount))
+        except (ImpossibleTransaction, InvalidInput, ZeroAmount):
+            data = None
         if not data:
             return Response({
                 'error': 'transaction could not be made'
@@ -217,7 +221,10 @@ class ProjectViewSet(MasterPostViewSet):
         user: User = request.user
         post: FundablePost = get_object_or_404(FundablePost, id=pk)
         self.check_object_permissions(request, post)
-        data = post.retrieve_from_post(user)
+        try:
+            data = post.retrieve_from_post(user)
+        except (ImpossibleTransaction, InvalidInput, ZeroAmount):
+            data = None
         if not data:
             return Response({
                 'error': 'transaction could not be made'
@@ -12,3 +12,8 @@ class TransacitonFailed(Exception):
 
 class InvalidInput(Exception):
     pass
+
+
+# Carries the JSON-RPC error object, e.args[0]["message"] reads like web3's ValueErrors
+class RPCError(ValueError):
+    pass
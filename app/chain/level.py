@@ -2,13 +2,19 @@ from web3.contract import Contract
 from hexbytes import HexBytes
 from django_redis import get_redis_connection
 from redis import Redis
+from redis.exceptions import LockError
 from decimal import Decimal
 from web3 import Web3
 import configuration
 from ast import literal_eval
+import asyncio
+import secrets
 import time
 
+import msgpack
+
 from chain.exceptions import ZeroAmount, TransacitonFailed, InvalidInput, ImpossibleTransaction
+from chain.rpc import AsyncRPCClient
 
 CHAIN_ABI = configuration.CHAIN_ABI
 CHAIN_URL = configuration.CHAIN_URL
@@ -31,16 +37,23 @@ class ChainAttributes:
     connected: bool | None = False
     balance: Decimal | None = None
     address: str | None = None
+    updated: float | None = None
 
-    def __init__(self, connected: bool, address: str, balance: Decimal | None = None) -> None:
+    def __init__(self,
+                 connected: bool,
+                 address: str,
+                 balance: Decimal | None = None,
+                 updated: float | None = None) -> None:
         self.connected = connected
         self.balance = balance
         self.address = address
+        self.updated = updated
 
     def __dict__(self):
         return {
             'connected': self.connected,
             'balance': f"{self.balance:.6f}" if self.balance is not None else None,
+            'updated': self.updated,
         }
 
 
@@ -55,9 +68,7 @@ class ChainManager(metaclass=Singleton):
 
     w3 = Web3(Web3.HTTPProvider(CHAIN_URL))
     contract: Contract = w3.eth.contract(address=CHAIN_ADDRESS, abi=CHAIN_ABI)
-    filter = contract.events.TransferRequest.createFilter(fromBlock="latest")
-    latest_event_hash = None
-    nonce = w3.eth.get_transaction_count(MASTER_ADDRESS)
+    cache: Redis = get_redis_connection()
 
     def chain_attributes(self, address: str | None) -> ChainAttributes:
         attributes: ChainAttributes = ChainAttributes(
@@ -70,40 +81,85 @@ class ChainManager(metaclass=Singleton):
             attributes.balance = Decimal(self.call("balanceOf", address))
         return attributes
 
-    def exp_decimals(self) -> int:
-        return pow(10, self.call("decimals"))
-
-    def get_transfer_logs(self):
+    # Every balance is one eth_call of a single batch request instead of a round-trip each
+    def chain_attributes_many(self, addresses: list[str]) -> dict[str, ChainAttributes]:
         try:
-            logs = self.filter.get_new_entries()
+            balances: dict[str, int] = self.balances(addresses)
+            connected: bool = True
         except Exception as e:
-            if e.args[0]["message"] == "filter not found":
-                self.filter = self.contract\
-                    .events.TransferRequest.createFilter(fromBlock="latest")
-            temp = self.contract\
-                .events.TransferRequest.createFilter(fromBlock=0, toBlock="latest")
-            all_logs = temp.get_all_entries()
-            index: int
-            for idx in range(len(all_logs)):
-                if self.latest_event_hash == all_logs[idx]["transactionHash"]:
-                    index = idx
-                    break
-            logs = all_logs[(index + 1):]
-        self.latest_event_hash = logs[-1]["transactionHash"] if len(logs) > 0 else None
-        return [transfer_requests["args"] for transfer_requests in logs]
-
-    def update_nonce(self, recalibrate: bool = False):
-        if recalibrate:
-            self.nonce = self.w3.eth.get_transaction_count(MASTER_ADDRESS)
-        else:
-            self.nonce += 1
+            print(e)
+            balances, connected = dict(), False
+        return {
+            address: ChainAttributes(
+                connected=connected,
+                address=address,
+                balance=Decimal(balances[address]) if address in balances else None
+            ) for address in addresses
+        }
+
+    def balances(self, addresses: list[str]) -> dict[str, int]:
+        return asyncio.run(self.fetch_balances(addresses))
+
+    async def fetch_balances(self, addresses: list[str]) -> dict[str, int]:
+        async with AsyncRPCClient(CHAIN_URL) as client:
+            results: list[str] = await asyncio.gather(*[
+                client.eth_call(
+                    CHAIN_ADDRESS, self.contract.encodeABI(fn_name=self.Functions.BALANCE_OF, args=[address]))
+                for address in addresses
+            ])
+        return {
+            address: self.w3.codec.decode_single("uint256", HexBytes(result))
+            for address, result in zip(addresses, results)
+        }
 
-    def get_nonce(self) -> int:
-        return self.nonce
+    # Receipts of many transactions in one batch request, None for the ones not mined yet
+    def receipts(self, hashes: list[str]) -> dict[str, dict | None]:
+        return asyncio.run(self.fetch_receipts(hashes))
 
+    @staticmethod
+    async def fetch_receipts(hashes: list[str]) -> dict[str, dict | None]:
+        async with AsyncRPCClient(CHAIN_URL) as client:
+            results: list[dict | None] = await asyncio.gather(*[
+                client.call("eth_getTransactionReceipt", tx_hash) for tx_hash in hashes
+            ])
+        return dict(zip(hashes, results))
+
+    # decimals is fixed when the token is deployed, the chain is asked only while token_decimals: is missing
+    def exp_decimals(self) -> int:
+        decimals: bytes | None = self.cache.get("token_decimals:")
+        if decimals is None:
+            decimals = self.call("decimals")
+            self.cache.set("token_decimals:", decimals)
+        return pow(10, int(decimals))
+
+    def latest_block(self) -> int:
+        return self.w3.eth.block_number
+
+    # eth_getLogs over [from_block, to_block], no filter lives on the node between calls
+    def get_transfer_logs(self, from_block: int, to_block: int) -> list:
+        return self.contract.events.TransferRequest.getLogs(fromBlock=from_block, toBlock=to_block)
+
+    # The input checks and the cached balance run here so their errors reach the caller without waiting
+    # for the chain, generate_transaction checks the balance on the chain before the transaction is queued
     def send(self, func_name: str, *args):
+        from_addr, to_addr, amount = Transaction.check_input(*args)
+        if from_addr is not None:
+            balance: Decimal | None = BalanceCache().get(from_addr).balance
+            if balance is not None and balance < amount:
+                raise ImpossibleTransaction()
+        self.queue(func_name, *args)
+
+    # Queues without any check, for callers that can't take an error back
+    def queue(self, func_name: str, *args):
         from chain.tasks import generate_transaction
-        generate_transaction(func_name, *args)
+        generate_transaction.delay(func_name, *args)
+
+    # Sends all of from_addr to to_addr, the amount is read when the transaction is built
+    def sweep(self, from_addr: str, to_addr: str):
+        from chain.tasks import sweep_balance
+        if not from_addr or not to_addr:
+            raise InvalidInput()
+        sweep_balance.delay(from_addr, to_addr)
 
     def call(self, func_name: str, *args):
         return self.contract.functions[func_name](*args).call()
@@ -113,14 +169,34 @@ class Transaction:
     txn: dict
     address: str
     error: int = 0
+    # times SignManager tried to replace the pending transaction, sent or not
+    replacements: int = 0
+    wire_version: int = 1
     chain = ChainManager()
 
     def __init__(self, func_name: str, *args):
+        self.hashes: list[str] = []
         if func_name == "cached":
             self.address = args[0]["address"]
             self.txn = args[0]["txn"]
+            self.error = args[0].get("error", 0)
+            self.hashes = args[0].get("hashes", [])
+            self.replacements = args[0].get("replacements", 0)
             return
 
+        to_addr: str = self.validate(*args)
+        self.txn = self.chain.contract.functions[func_name](*args).buildTransaction({
+            "chainId": CHAIN_ID,
+            "gasPrice": self.chain.w3.eth.gasPrice,
+            "from": MASTER_ADDRESS,
+            "nonce": 0
+        })
+
+        self.address = to_addr
+
+    # Splits a (from, to, amount), (to, amount) or (to) call, nothing is read from the chain
+    @staticmethod
+    def check_input(*args) -> tuple[str | None, str, int | None]:
         from_addr = None
         to_addr = None
         amount = None
@@ -140,83 +216,387 @@ class Transaction:
 
         if (amount is not None) and amount == 0:
             raise ZeroAmount()
+        return from_addr, to_addr, amount
 
-        if (from_addr is not None) and self.chain.call("balanceOf", from_addr) < amount:
+    # Returns the receiving address once the sender's balance on the chain covers the amount
+    @classmethod
+    def validate(cls, *args) -> str:
+        from_addr, to_addr, amount = cls.check_input(*args)
+        if (from_addr is not None) and cls.chain.call("balanceOf", from_addr) < amount:
             raise ImpossibleTransaction()
+        return to_addr
 
-        self.txn = self.chain.contract.functions[func_name](*args).buildTransaction({
-            "chainId": CHAIN_ID,
-            "gasPrice": self.chain.w3.eth.gasPrice,
-            "from": MASTER_ADDRESS,
-            "nonce": 0
-        })
-
-        self.address = to_addr
-
-    def sign(self) -> HexBytes:
-        if self.error == 10:
+    # Signs with the given nonce and broadcasts, the receipt is left to SignManager.confirm
+    def sign(self, nonce: int) -> HexBytes:
+        if self.error >= 10:
             raise TransacitonFailed()
-        self.txn["nonce"] = self.chain.get_nonce()
-        self.chain.update_nonce()
+        self.txn["nonce"] = nonce
         signed_tx = self.chain.w3.eth.account.sign_transaction(self.txn, private_key=MASTER_KEY)
-        try:
-            return self.chain.w3.eth.send_raw_transaction(signed_tx.rawTransaction)
-        except Exception as e:
-            self.error += 1
-            if type(e) == ValueError:
-                match e.args[0]["message"]:
-                    case "nonce too low":
-                        self.chain.update_nonce(recalibrate=True)
-                        self.txn["nonce"] = self.chain.get_nonce()
-                        return self.sign()
-                    case "transaction underpriced" | "replacement transaction underpriced":
-                        self.txn["gasPrice"] = int(1.1 * self.txn["gasPrice"])
-                        return self.sign()
-                    case _:
-                        raise e
-
-    def safe_sign(self):
-        if self.error == 10:
-            raise TransacitonFailed()
-        bef_t_balance = self.chain.call("balanceOf", self.address)
-        try:
-            tx_receipt = self.chain.w3.eth.wait_for_transaction_receipt(self.sign(), poll_latency=0.75)
-        except Exception as e:
-            if type(e) == ValueError and int(e.args[0]["code"]) == 429:
-                time.sleep(20)
-                self.safe_sign()
-            else:
-                return
-        aft_t_balance = self.chain.call("balanceOf", self.address)
-        if aft_t_balance - bef_t_balance == 0 or tx_receipt["status"] == 0:
-            self.error += 1
-            self.safe_sign()
+        tx_hash: HexBytes = self.chain.w3.eth.send_raw_transaction(signed_tx.rawTransaction)
+        self.hashes.append(tx_hash.hex())
+        return tx_hash
+
+    # replacing a pending transaction takes at least a 10% higher gas price
+    def reprice(self) -> None:
+        self.txn["gasPrice"] = int(1.125 * self.txn["gasPrice"])
 
     def __str__(self) -> str:
-        return str({"txn": self.txn, "address": self.address})
+        return str({
+            "txn": self.txn,
+            "address": self.address,
+            "error": self.error,
+            "hashes": self.hashes,
+            "replacements": self.replacements
+        })
+
+    # msgpack holds integers up to 64 bits, larger ones travel as big-endian bytes in ext type 1
+    @staticmethod
+    def pack_default(value):
+        if isinstance(value, int):
+            return msgpack.ExtType(1, value.to_bytes((value.bit_length() + 8) // 8, "big", signed=True))
+        raise TypeError(f"Can't serialize {type(value).__name__}")
+
+    @staticmethod
+    def unpack_ext(code: int, data: bytes):
+        if code == 1:
+            return int.from_bytes(data, "big", signed=True)
+        return msgpack.ExtType(code, data)
+
+    def to_bytes(self) -> bytes:
+        return msgpack.packb({
+            "v": self.wire_version,
+            "txn": self.txn,
+            "address": self.address,
+            "error": self.error,
+            "hashes": self.hashes,
+            "replacements": self.replacements
+        }, default=self.pack_default)
 
     @staticmethod
     def from_bytes(txn: bytes) -> "Transaction":
-        txn_dict = literal_eval(txn.decode("utf-8"))
+        # queued by the str() format before the wire format was versioned
+        if txn.startswith(b"{"):
+            return Transaction("cached", literal_eval(txn.decode("utf-8")))
+        txn_dict: dict = msgpack.unpackb(txn, ext_hook=Transaction.unpack_ext)
+        if txn_dict.get("v") != Transaction.wire_version:
+            raise InvalidInput()
         return Transaction("cached", txn_dict)
 
 
+# KEYS: txn_queue:, txn_processing:  ARGV: batch size
+# Moves up to a batch of transactions from the queue to the processing list and returns them
+CLAIM_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+end
+return items
+"""
+
+
+def rpc_message(e: Exception) -> str:
+    return e.args[0].get("message", "") if e.args and isinstance(e.args[0], dict) else str(e)
+
+
+# Broadcasts queued transactions back to back, nonces are handed out by the atomic Redis counter nonce:.
+# Every broadcast nonce waits in txn_sent: with the hashes sent for it until confirm() finds a receipt.
+# Nonces without one after reprice_after seconds are sent again at a higher gas price up to max_replacements
+# times, then they are left to txn_dead:. Failed transactions go back to the queue for a new nonce.
+# Claimed transactions stay in txn_processing: until they are tracked or queued again in the same
+# MULTI, whatever a crashed signer left there is queued again by the next one.
 class SignManager(metaclass=Singleton):
     cache: Redis = get_redis_connection()
+    claim_script = cache.register_script(CLAIM_SCRIPT)
+    chain = ChainManager()
+    lock_timeout: int = 60
+    reprice_after: int = 60
+    max_errors: int = 10
+    # 1.125 ** 8 is about 2.6 times the first price
+    max_replacements: int = 8
+    batch_size: int = 100
+
+    def add_txn(self, txn: Transaction, pipeline=None):
+        (pipeline if pipeline is not None else self.cache).rpush("txn_queue:", txn.to_bytes())
+
+    def next_nonce(self) -> int:
+        if not self.cache.exists("nonce:"):
+            self.cache.set("nonce:", self.chain.w3.eth.get_transaction_count(MASTER_ADDRESS, "pending"), nx=True)
+        return self.cache.incr("nonce:") - 1
+
+    # A broadcast that failed leaves its nonce unused, the node's pending count hands it out again
+    def recalibrate_nonce(self) -> None:
+        self.cache.set("nonce:", self.chain.w3.eth.get_transaction_count(MASTER_ADDRESS, "pending"))
+
+    def track(self, txn: Transaction, pipeline=None) -> None:
+        nonce: int = txn.txn["nonce"]
+        own_pipeline = pipeline is None
+        pipeline = pipeline if pipeline is not None else self.cache.pipeline()
+        pipeline.hset("txn_sent:", nonce, txn.to_bytes())
+        pipeline.zadd("txn_sent_at:", {nonce: time.time()})
+        if own_pipeline:
+            pipeline.execute()
+
+    def untrack(self, nonce: int) -> None:
+        pipeline = self.cache.pipeline()
+        pipeline.hdel("txn_sent:", nonce)
+        pipeline.zrem("txn_sent_at:", nonce)
+        pipeline.execute()
+
+    def retry(self, txn: Transaction, pipeline=None) -> None:
+        txn.error += 1
+        txn.hashes = []
+        txn.replacements = 0
+        if txn.error >= self.max_errors:
+            print(f"Transaction failed {txn.error} times, dropped: {txn}")
+            return
+        self.add_txn(txn, pipeline)
+
+    def broadcast(self, raw: bytes) -> None:
+        pipeline = self.cache.pipeline()
+        pipeline.lrem("txn_processing:", 1, raw)
+        try:
+            txn: Transaction = Transaction.from_bytes(raw)
+        except Exception as e:
+            print(f"Unreadable transaction moved to txn_dead: {e}")
+            pipeline.rpush("txn_dead:", raw)
+            pipeline.execute()
+            return
 
-    def add_txn(self, txn: Transaction):
-        self.cache.rpush("txn_queue:", str(txn))
+        try:
+            txn.sign(self.next_nonce())
+        except Exception as e:
+            self.recalibrate_nonce()
+            if rpc_message(e) in ("transaction underpriced", "replacement transaction underpriced"):
+                txn.reprice()
+            self.retry(txn, pipeline)
+        else:
+            self.track(txn, pipeline)
+        pipeline.execute()
 
-    def has_next(self) -> bool:
-        if not self.cache.exists("txn_queue:"):
-            self.cache.set("signing", "0")
-        return self.is_signing()
+    def recover(self) -> None:
+        while self.cache.lmove("txn_processing:", "txn_queue:", "RIGHT", "LEFT") is not None:
+            pass
 
+    # The lock is renewed before every broadcast, a signer that lost it stops before sending anything else
+    # and leaves the rest of its batch in txn_processing: for the next one
     def start_signing(self):
-        self.cache.set("signing", "1")
-        while self.has_next():
-            txn: Transaction = Transaction.from_bytes(self.cache.lpop("txn_queue:"))
-            txn.safe_sign()
+        lock = self.cache.lock("signing", timeout=self.lock_timeout)
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            self.recover()
+            while batch := self.claim_script(keys=["txn_queue:", "txn_processing:"], args=[self.batch_size]):
+                for raw in batch:
+                    lock.reacquire()
+                    self.broadcast(raw)
+        except LockError as e:
+            print(f"Signing lock lost: {e}")
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                pass
 
     def is_signing(self) -> bool:
-        return int(self.cache.get("signing")) == 1
+        return self.cache.exists("signing") == 1
+
+    # Receipts of every hash sent for every pending nonce are asked for in one batch request
+    def confirm(self) -> int:
+        sent: dict[int, Transaction] = {
+            int(nonce): Transaction.from_bytes(txn) for nonce, txn in self.cache.hgetall("txn_sent:").items()
+        }
+        if not sent:
+            return 0
+        sent_at: dict[int, float] = {
+            int(nonce): score for nonce, score in self.cache.zrange("txn_sent_at:", 0, -1, withscores=True)
+        }
+        receipts: dict[str, dict | None] = self.chain.receipts(
+            [tx_hash for txn in sent.values() for tx_hash in txn.hashes])
+
+        confirmed: int = 0
+        for nonce, txn in sent.items():
+            # a nonce that can't be handled now is looked at again by the next confirm
+            try:
+                receipt: dict | None = next(
+                    (receipts[tx_hash] for tx_hash in txn.hashes if receipts.get(tx_hash)), None)
+                if receipt is not None:
+                    self.untrack(nonce)
+                    if int(receipt["status"], 16) == 1:
+                        confirmed += 1
+                    else:
+                        self.retry(txn)
+                elif time.time() - sent_at.get(nonce, 0) > self.reprice_after:
+                    self.replace(txn)
+            except Exception as e:
+                print(f"Nonce {nonce} not confirmed: {e}")
+        return confirmed
+
+    # Sends the same nonce again at a higher price, "nonce too low" means one of its hashes got mined.
+    # Every attempt counts towards max_replacements, the higher price is kept only once it was sent.
+    def replace(self, txn: Transaction) -> None:
+        txn.replacements += 1
+        if txn.replacements > self.max_replacements:
+            print(f"Nonce {txn.txn['nonce']} not mined after {txn.replacements - 1} replacements, moved to txn_dead:")
+            pipeline = self.cache.pipeline()
+            pipeline.hdel("txn_sent:", txn.txn["nonce"])
+            pipeline.zrem("txn_sent_at:", txn.txn["nonce"])
+            pipeline.rpush("txn_dead:", txn.to_bytes())
+            pipeline.execute()
+            return
+        price: int = txn.txn["gasPrice"]
+        txn.reprice()
+        try:
+            txn.sign(txn.txn["nonce"])
+        except Exception as e:
+            txn.txn["gasPrice"] = price
+            print(f"Replacement of nonce {txn.txn['nonce']} not sent: {rpc_message(e)}")
+        self.track(txn)
+
+
+# Balances read by the API come from here and never wait for the chain.
+# Each address is a hash balance:<address> with its balance and the time it was read from the chain.
+# Misses and entries older than refresh_after are queued in balance_requested:, the refresh_balances
+# task reads them from the chain together with the cached addresses that took part in new Transfer events.
+class BalanceCache(metaclass=Singleton):
+    cache: Redis = get_redis_connection()
+    ttl: int = 24 * 60 * 60
+    refresh_after: int = 5 * 60
+    # bounds the blocks one refresh asks Transfer events for
+    max_block_range: int = 2000
+
+    @staticmethod
+    def key(address: str) -> str:
+        return f"balance:{address}"
+
+    def get(self, address: str | None) -> ChainAttributes:
+        if not address:
+            return ChainAttributes(connected=self.is_connected(), address=address)
+        return self.get_many([address])[address]
+
+    def get_many(self, addresses: list[str]) -> dict[str, ChainAttributes]:
+        pipeline = self.cache.pipeline(transaction=False)
+        for address in addresses:
+            pipeline.hmget(self.key(address), "balance", "updated")
+        entries: list = pipeline.execute()
+
+        connected: bool = self.is_connected()
+        now: float = time.time()
+        attributes: dict[str, ChainAttributes] = dict()
+        requested: list[str] = []
+        for address, (balance, updated) in zip(addresses, entries):
+            updated = float(updated) if updated is not None else None
+            if updated is None or now - updated > self.refresh_after:
+                requested.append(address)
+            attributes[address] = ChainAttributes(
+                connected=connected,
+                address=address,
+                balance=Decimal(balance.decode("utf-8")) if balance is not None else None,
+                updated=updated
+            )
+        if requested:
+            self.cache.sadd("balance_requested:", *requested)
+        return attributes
+
+    def is_connected(self) -> bool:
+        return self.cache.get("chain_connected") == b"1"
+
+    def store(self, balances: dict[str, Decimal | int], connected: bool = True) -> None:
+        now: float = time.time()
+        pipeline = self.cache.pipeline(transaction=False)
+        for address, balance in balances.items():
+            pipeline.hset(self.key(address), mapping={"balance": str(balance), "updated": now})
+            pipeline.expire(self.key(address), self.ttl)
+        pipeline.set("chain_connected", "1" if connected else "0")
+        pipeline.execute()
+
+    def transferred_addresses(self, chain: "ChainManager") -> set[str]:
+        latest: int = chain.w3.eth.block_number
+        checkpoint: bytes | None = self.cache.get("balance_block:")
+        start: int = int(checkpoint) + 1 if checkpoint is not None else latest
+        end: int = min(latest, start + self.max_block_range - 1)
+        if start > end:
+            return set()
+        logs = chain.contract.events.Transfer.getLogs(fromBlock=start, toBlock=end)
+        self.cache.set("balance_block:", end)
+        addresses: set[str] = {address for log in logs for address in (log["args"]["from"], log["args"]["to"])}
+        # only addresses someone reads are worth keeping fresh
+        pipeline = self.cache.pipeline(transaction=False)
+        for address in addresses:
+            pipeline.exists(self.key(address))
+        return {address for address, cached in zip(addresses, pipeline.execute()) if cached}
+
+    def refresh(self, chain: "ChainManager") -> int:
+        connected: bool = chain.w3.isConnected()
+        if not connected:
+            self.cache.set("chain_connected", "0")
+            return 0
+        addresses: set[str] = {
+            address.decode("utf-8") for address in self.cache.spop("balance_requested:", 10 ** 6) or []
+        }
+        addresses |= self.transferred_addresses(chain)
+        balances: dict[str, int] = chain.balances(list(addresses)) if addresses else dict()
+        self.store(balances, connected=connected)
+        return len(balances)
+
+
+# KEYS: xp_ledger:, xp_flushing:, xp_flushing_id:  ARGV: id for a new batch
+# Returns the id and the entries of the batch being flushed, starting a new one from the ledger if there is none.
+# A batch left by a crashed flusher is returned again with its id before the ledger is touched.
+XP_CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return {}
+    end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+    redis.call('DEL', KEYS[3])
+end
+redis.call('SET', KEYS[3], ARGV[1], 'NX')
+local entries = redis.call('HGETALL', KEYS[2])
+table.insert(entries, 1, redis.call('GET', KEYS[3]))
+return entries
+"""
+
+# KEYS: xp_flushing:, xp_flushing_id:, xp_flush_lock:  ARGV: batch id, 1 if it was flushed, lock token
+# Drops the batch only if it is still the flushed one and the lock only if it is still held by the token
+XP_RELEASE_SCRIPT = """
+if ARGV[2] == '1' and redis.call('GET', KEYS[2]) == ARGV[1] then
+    redis.call('DEL', KEYS[1], KEYS[2])
+end
+if redis.call('GET', KEYS[3]) == ARGV[3] then
+    redis.call('DEL', KEYS[3])
+end
+"""
+
+
+# Rewards are added to the user's counter in the xp_ledger: hash instead of the ChainPage row,
+# the flush_xp task moves the counters to xp_flushing: and folds them into ChainPage in batches.
+# Every batch has an id in xp_flushing_id:, ChainPage.flush_xp commits the id with the xp
+# and skips a batch it already applied, so a flusher that outlived its lock or crashed after
+# the commit doesn't apply a batch twice.
+class XPLedger(metaclass=Singleton):
+    cache: Redis = get_redis_connection()
+    claim_script = cache.register_script(XP_CLAIM_SCRIPT)
+    release_script = cache.register_script(XP_RELEASE_SCRIPT)
+    lock_timeout: int = 60
+
+    def add(self, user_id: int, amount: int) -> None:
+        self.cache.hincrby("xp_ledger:", user_id, amount)
+
+    # Returns the lock token, the batch id and its entries; no entries while another flusher holds the lock
+    def claim(self) -> tuple[str, str, dict[int, int]]:
+        token: str = secrets.token_hex(8)
+        if not self.cache.set("xp_flush_lock:", token, nx=True, ex=self.lock_timeout):
+            return token, "", dict()
+        result: list[bytes] = self.claim_script(
+            keys=["xp_ledger:", "xp_flushing:", "xp_flushing_id:"], args=[secrets.token_hex(8)])
+        if not result:
+            self.release(token, "", False)
+            return token, "", dict()
+        entries: list[bytes] = result[1:]
+        return token, result[0].decode("utf-8"), {
+            int(user_id): int(amount) for user_id, amount in zip(entries[::2], entries[1::2])}
+
+    def release(self, token: str, batch: str, flushed: bool) -> None:
+        self.release_script(
+            keys=["xp_flushing:", "xp_flushing_id:", "xp_flush_lock:"], args=[batch, int(flushed), token])
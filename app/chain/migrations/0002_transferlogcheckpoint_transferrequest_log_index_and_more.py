@@ -0,0 +1,37 @@
+# Generated by Django 4.0.6 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chain', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransferLogCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('block', models.PositiveBigIntegerField(blank=True, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='transferrequest',
+            name='log_index',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transferrequest',
+            name='tx_hash',
+            field=models.CharField(blank=True, max_length=66, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='transferrequest',
+            constraint=models.UniqueConstraint(fields=('tx_hash', 'log_index'), name='unique_transfer_log'),
+        ),
+    ]
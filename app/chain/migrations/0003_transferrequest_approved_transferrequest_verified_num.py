@@ -0,0 +1,31 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_verifications(apps, schema_editor):
+    TransferRequest = apps.get_model('chain', 'TransferRequest')
+    verifications = TransferRequest.verified_by.through.objects.filter(transferrequest=OuterRef('pk')) \
+        .order_by().values('transferrequest').annotate(count=Count('id')).values('count')
+    TransferRequest.objects.update(verified_num=Coalesce(Subquery(verifications), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chain', '0002_transferlogcheckpoint_transferrequest_log_index_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transferrequest',
+            name='approved',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='transferrequest',
+            name='verified_num',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_verifications, migrations.RunPython.noop),
+    ]
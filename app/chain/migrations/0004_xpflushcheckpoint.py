@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chain', '0003_transferrequest_approved_transferrequest_verified_num'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XPFlushCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch', models.CharField(blank=True, max_length=16, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -1,14 +1,15 @@
 import secrets
 
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Exists, F, OuterRef, QuerySet, Value, When
 from django.utils.translation import gettext_lazy as _
 from eth_account import Account
 
-from api.models import ChainConfig, ChainProfile
+from api.models import ChainConfigCache, ChainProfile, SingletonModel
 from api.tasks import send_level_up_notification
 from subjects.models import Community
-from .level import ChainManager
+from .level import ChainManager, XPLedger
 
 BASE_XP_LIMIT = 1000
 DIFFICULTY_PER_LEVEL = 100
@@ -64,21 +65,17 @@ class ChainPage(Wallet):
     def stake_levels(self) -> None:
         if self.level <= self.staked_level:
             raise Exception("Only one or more levels can be staked")
-        config: ChainConfig = ChainConfig.load()
+        profile: ChainProfile = ChainConfigCache().profile()
         self.verifications += (self.level - self.staked_level) \
-                              * config.profile.verification_per_level
+                              * profile.verification_per_level
         self.staked_level = self.level
-        self.save()
+        self.save(update_fields=["verifications", "staked_level"])
 
+    # Only appends to the ledger, xp and level are updated by the next flush_xp
     def get_reward(self, action: str | None, amount: int | None = None) -> None:
-        config: ChainConfig = ChainConfig.load()
         if amount is None:
-            amount = config.profile.get_reward(action)
-        self.xp += amount
-        if self.get_current_xp() >= self.get_target_xp():
-            self.level += 1
-            send_level_up_notification(self.user)
-        self.save()
+            amount = ChainConfigCache().reward(action)
+        XPLedger().add(self.user_id, amount)
 
     @staticmethod
     def level_cap(level: int) -> int:
@@ -88,15 +85,64 @@ class ChainPage(Wallet):
             diff = 0
         return base + diff
 
+    # Xp a page of level has to reach for level + 1
+    @classmethod
+    def level_threshold(cls, level: int) -> int:
+        return cls.level_cap(level - 1) + BASE_XP_LIMIT + DIFFICULTY_PER_LEVEL * level
+
+    # Level a page of level reaches with xp, one threshold at a time so several levels can be gained at once
+    @classmethod
+    def level_for(cls, xp: int, level: int = 0) -> int:
+        while xp >= cls.level_threshold(level):
+            level += 1
+        return level
+
+    # Adds the ledger to xp chunk_size pages per UPDATE and levels pages up as far as their xp reaches.
+    # The batch id is committed with the xp, a batch claimed again after that is only dropped from the ledger.
+    @classmethod
+    def flush_xp(cls, chunk_size: int = 500) -> int:
+        ledger: XPLedger = XPLedger()
+        token, batch, entries = ledger.claim()
+        if not entries:
+            return 0
+
+        leveled: list[int] = []
+        flushed: bool = False
+        try:
+            with transaction.atomic():
+                checkpoint: XPFlushCheckpoint = XPFlushCheckpoint.load()
+                checkpoint = XPFlushCheckpoint.objects.select_for_update().get(pk=checkpoint.pk)
+                if checkpoint.batch == batch:
+                    entries = dict()
+                checkpoint.batch = batch
+                checkpoint.save()
+                user_ids: list[int] = list(entries)
+                for start in range(0, len(user_ids), chunk_size):
+                    chunk: list[int] = user_ids[start:start + chunk_size]
+                    cls.objects.filter(user_id__in=chunk).update(xp=F("xp") + Case(
+                        *[When(user_id=user_id, then=Value(entries[user_id])) for user_id in chunk],
+                        default=Value(0)
+                    ))
+                    for page_id, user_id, xp, level in cls.objects.filter(user_id__in=chunk) \
+                            .values_list("id", "user_id", "xp", "level"):
+                        if cls.level_for(xp, level) > level:
+                            cls.objects.filter(id=page_id).update(level=cls.level_for(xp, level))
+                            leveled.append(user_id)
+            flushed = True
+        finally:
+            ledger.release(token, batch, flushed)
+
+        for user_id in leveled:
+            send_level_up_notification.delay(user_id)
+        return len(entries)
+
     def get_current_xp(self) -> int:
         xp: int = self.xp
         curr_cap: int = self.level_cap(self.level - 1)
         return xp - curr_cap
 
     def get_target_xp(self) -> int:
-        cap: int = self.level_cap(self.level)
-        diff: int = self.level * BASE_XP_LIMIT
-        return cap - diff
+        return self.level_threshold(self.level) - self.level_cap(self.level - 1)
 
     def save(self, *args, **kwargs):
         if self.verified_state == self.VerifiedState.ACCEPTED \
@@ -105,27 +151,91 @@ class ChainPage(Wallet):
         super(ChainPage, self).save(*args, **kwargs)
 
 
+# Last block whose TransferRequest events are ingested
+class TransferLogCheckpoint(SingletonModel):
+    block = models.PositiveBigIntegerField(null=True, blank=True)
+
+
+# Id of the last XP ledger batch added to ChainPage
+class XPFlushCheckpoint(SingletonModel):
+    batch = models.CharField(max_length=16, null=True, blank=True)
+
+
 class TransferRequest(models.Model):
     amount = models.PositiveIntegerField()
     from_addr = models.CharField(max_length=200)
     to_addr = models.CharField(max_length=200)
     verified_by = models.ManyToManyField(User)
-
+    # count of verified_by, approval fires when it reaches the target once and sets approved
+    verified_num = models.PositiveIntegerField(default=0)
+    approved = models.BooleanField(default=False)
+    tx_hash = models.CharField(max_length=66, null=True, blank=True)
+    log_index = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["tx_hash", "log_index"], name="unique_transfer_log")
+        ]
+
+    # Reads events block_range blocks at a time from the block after the checkpoint.
+    # Rows and checkpoint of a range are written together, a crash repeats at most that range
+    # and the unique (tx_hash, log_index) drops the rows written before.
+    @classmethod
+    def ingest(cls, block_range: int = 2000) -> int:
+        chain: ChainManager = ChainManager()
+        latest: int = chain.latest_block()
+        checkpoint: TransferLogCheckpoint = TransferLogCheckpoint.load()
+        start: int = checkpoint.block + 1 if checkpoint.block is not None else latest
+        ingested: int = 0
+        while start <= latest:
+            end: int = min(start + block_range - 1, latest)
+            logs: list = chain.get_transfer_logs(start, end)
+            with transaction.atomic():
+                cls.objects.bulk_create([
+                    cls(
+                        from_addr=log["args"]["from"],
+                        to_addr=log["args"]["to"],
+                        amount=log["args"]["amount"],
+                        tx_hash=log["transactionHash"].hex(),
+                        log_index=log["logIndex"]
+                    ) for log in logs
+                ], ignore_conflicts=True)
+                checkpoint.block = end
+                checkpoint.save()
+            ingested += len(logs)
+            start = end + 1
+        return ingested
+
+    @classmethod
+    def with_verifications(cls, user: User) -> QuerySet['TransferRequest']:
+        return cls.objects.annotate(is_verified=Exists(
+            cls.verified_by.through.objects.filter(transferrequest=OuterRef("pk"), user=user)
+        ))
+
+    # Verifications of one request take its row lock in turn, so only one of them can flip approved.
+    # The mint and the transfer are queued once the approval commits, their balance checks run in the task.
     def verify(self, user: User):
-        if self.verified_by.all().contains(user):
-            raise Exception("Same user can't verify same transaction twice")
-        chain_page: ChainPage = user.chainpage
-        chain_page.verifications = user.chainpage.verifications - 1
-        config: ChainConfig = ChainConfig.load()
-        ChainManager().send(
-            "mint",
-            user.chainpage.wallet_address,
-            config.profile.token_per_verification
-        )
-
-        self.verified_by.add(user)
-        chain_page.save()
-        self.save()
+        profile: ChainProfile = ChainConfigCache().profile()
+        chain: ChainManager = ChainManager()
+        wallet_address: str = user.chainpage.wallet_address
+        with transaction.atomic():
+            TransferRequest.objects.select_for_update().filter(id=self.id).first()
+            if self.verified_by.filter(id=user.id).exists():
+                raise Exception("Same user can't verify same transaction twice")
+            self.verified_by.add(user)
+            ChainPage.objects.filter(user=user).update(verifications=F("verifications") - 1)
+            TransferRequest.objects.filter(id=self.id).update(verified_num=F("verified_num") + 1)
+            approved: bool = TransferRequest.objects.filter(
+                id=self.id,
+                approved=False,
+                verified_num__gte=profile.target_approval_number
+            ).update(approved=True) == 1
+            transaction.on_commit(lambda: chain.queue(
+                ChainManager.Functions.MINT, wallet_address, profile.token_per_verification))
+            if approved:
+                transaction.on_commit(lambda: chain.queue(
+                    ChainManager.Functions.ON_TRANSACTION_VERIFIED, self.from_addr, self.to_addr, self.amount))
+        self.refresh_from_db(fields=["verified_num", "approved"])
 
     def __str__(self) -> str:
         return f"Transaction from {self.from_addr}"
@@ -0,0 +1,95 @@
+import asyncio
+import json
+from itertools import count
+
+import aiohttp
+
+from chain.exceptions import RPCError
+
+
+# JSON-RPC client that sends every call made within batch_delay of each other as one batch request.
+# Identical calls in flight share one request, connections are pooled by the session.
+class AsyncRPCClient:
+    max_batch: int = 100
+    batch_delay: float = 0.002
+    pool_size: int = 10
+
+    def __init__(self, url: str) -> None:
+        self.url: str = url
+        self.session: aiohttp.ClientSession | None = None
+        self.ids = count(1)
+        self.pending: list[tuple[int, dict, asyncio.Future]] = []
+        self.in_flight: dict[str, asyncio.Future] = dict()
+        self.sending: set[asyncio.Task] = set()
+        self.flush_handle: asyncio.TimerHandle | None = None
+
+    async def __aenter__(self) -> "AsyncRPCClient":
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.flush()
+        if self.sending:
+            await asyncio.wait(self.sending)
+        await self.session.close()
+
+    def request(self, method: str, params: list) -> asyncio.Future:
+        key: str = json.dumps([method, params], sort_keys=True)
+        if key in self.in_flight:
+            return self.in_flight[key]
+
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future = loop.create_future()
+        self.in_flight[key] = future
+        future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        self.pending.append((next(self.ids), {"jsonrpc": "2.0", "method": method, "params": params}, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_delay, self.flush)
+        return future
+
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task: asyncio.Task = asyncio.create_task(self.send(batch))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    async def send(self, batch: list[tuple[int, dict, asyncio.Future]]) -> None:
+        payload: list[dict] = [{**call, "id": call_id} for call_id, call, _ in batch]
+        try:
+            async with self.session.post(self.url, json=payload) as response:
+                response.raise_for_status()
+                responses = await response.json(content_type=None)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # a node rejecting the whole batch answers with a single error object
+        if isinstance(responses, dict):
+            responses = [{**responses, "id": call_id} for call_id, _, _ in batch] \
+                if "error" in responses else [responses]
+        by_id: dict = {response.get("id"): response for response in responses}
+        for call_id, _, future in batch:
+            if future.done():
+                continue
+            response: dict | None = by_id.get(call_id)
+            if response is None:
+                future.set_exception(RPCError({"code": -32603, "message": "missing response"}))
+            elif "error" in response:
+                future.set_exception(RPCError(response["error"]))
+            else:
+                future.set_result(response.get("result"))
+
+    # shielded, a cancelled caller doesn't cancel the calls coalesced with it
+    async def call(self, method: str, *params):
+        return await asyncio.shield(self.request(method, list(params)))
+
+    async def eth_call(self, to: str, data: str, block: str = "latest") -> str:
+        return await self.call("eth_call", {"to": to, "data": data}, block)
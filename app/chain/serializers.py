@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .level import ChainManager
+from .level import BalanceCache
 from subjects.serializers import SmallProfileSerializer
 from .models import TransferRequest, ChainPage
 from django.contrib.auth.models import User
@@ -25,7 +25,7 @@ class ChainPageSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def get_chain_attributes(obj: ChainPage) -> dict:
-        return ChainManager().chain_attributes(obj.wallet_address).__dict__()
+        return BalanceCache().get(obj.wallet_address).__dict__()
 
     class Meta:
         model = ChainPage
@@ -52,6 +52,8 @@ class TransferRequestSerializer(serializers.ModelSerializer):
     verified_num = serializers.SerializerMethodField()
 
     def get_is_verified(self, obj: TransferRequest):
+        if hasattr(obj, "is_verified"):
+            return obj.is_verified
         user: User = self.context['request'].user
         return obj.verified_by.all().contains(user)
 
@@ -59,8 +61,9 @@ class TransferRequestSerializer(serializers.ModelSerializer):
     def get_amount(obj: TransferRequest) -> str:
         return str(obj.amount)
 
-    def get_verified_num(self, obj: TransferRequest):
-        return obj.verified_by.count()
+    @staticmethod
+    def get_verified_num(obj: TransferRequest):
+        return obj.verified_num
 
     class Meta:
         model = TransferRequest
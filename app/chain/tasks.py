@@ -1,19 +1,26 @@
 from celery import shared_task
 
-from chain.models import TransferRequest
-from chain.level import ChainManager, SignManager, Transaction
+from chain.exceptions import ImpossibleTransaction, InvalidInput, ZeroAmount
+from chain.models import ChainPage, TransferRequest
+from chain.level import BalanceCache, ChainManager, SignManager, Transaction
 
 
 @shared_task(name="create_transfer_log")
 def create_transfer_log():
-    log_data = ChainManager().get_transfer_logs()
-    for log in log_data:
-        TransferRequest.objects.create(
-            from_addr=log["from"],
-            to_addr=log["to"],
-            amount=log["amount"]
-        )
-    print(f"{len(log_data)} logs created.")
+    ingested: int = TransferRequest.ingest()
+    print(f"{ingested} logs created.")
+
+
+@shared_task(name="flush_xp")
+def flush_xp():
+    flushed: int = ChainPage.flush_xp()
+    print(f"{flushed} xp entries flushed.")
+
+
+@shared_task(name="refresh_balances")
+def refresh_balances():
+    refreshed: int = BalanceCache().refresh(ChainManager())
+    print(f"{refreshed} balances refreshed.")
 
 
 @shared_task(name="sign_transactions")
@@ -23,6 +30,32 @@ def sign_transactions():
         return
     SignManager().start_signing()
 
-@shared_task
-def generate_transaction(func_name: str, *args):
-    SignManager().add_txn(Transaction(func_name, *args))
+
+@shared_task(name="confirm_transactions")
+def confirm_transactions():
+    confirmed: int = SignManager().confirm()
+    print(f"{confirmed} transactions confirmed.")
+
+
+# A transaction the balance or input rules out is dropped,
+# anything else (the node or Redis unreachable) is tried again
+@shared_task(bind=True, max_retries=10)
+def generate_transaction(self, func_name: str, *args):
+    try:
+        SignManager().add_txn(Transaction(func_name, *args))
+    except (ImpossibleTransaction, InvalidInput, ZeroAmount) as e:
+        print(f"Transaction {func_name}{args} dropped: {type(e).__name__}")
+    except Exception as e:
+        raise self.retry(exc=e, countdown=30)
+
+
+@shared_task(bind=True, max_retries=10)
+def sweep_balance(self, from_addr: str, to_addr: str):
+    try:
+        amount: int = ChainManager().call(ChainManager.Functions.BALANCE_OF, from_addr)
+    except Exception as e:
+        raise self.retry(exc=e, countdown=30)
+    if amount == 0:
+        print(f"Nothing to sweep from {from_addr}")
+        return
+    generate_transaction.delay(ChainManager.Functions.SEND_TOKEN, from_addr, to_addr, amount)
@@ -0,0 +1,59 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from django.test import SimpleTestCase
+
+from chain.exceptions import RPCError
+from chain.rpc import AsyncRPCClient
+
+
+# Answers eth_call with the call data echoed back and remembers every request it got
+class FakeRPCServer:
+    def __init__(self) -> None:
+        self.requests: list = []
+        self.app = web.Application()
+        self.app.router.add_post("/", self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        self.requests.append(payload)
+        return web.json_response([self.respond(call) for call in payload])
+
+    @staticmethod
+    def respond(call: dict) -> dict:
+        if call["method"] == "eth_call":
+            return {"jsonrpc": "2.0", "id": call["id"], "result": call["params"][0]["data"]}
+        return {"jsonrpc": "2.0", "id": call["id"], "error": {"code": -32601, "message": "method not found"}}
+
+
+class AsyncRPCClientTestCase(SimpleTestCase):
+    def run_against_server(self, calls) -> tuple[list, FakeRPCServer]:
+        fake = FakeRPCServer()
+
+        async def run():
+            async with TestServer(fake.app) as server:
+                async with AsyncRPCClient(str(server.make_url("/"))) as client:
+                    return await asyncio.gather(*calls(client), return_exceptions=True)
+
+        return asyncio.run(run()), fake
+
+    def test_calls_are_batched(self):
+        results, fake = self.run_against_server(
+            lambda client: [client.eth_call("0xtoken", f"0x{i:02x}") for i in range(50)])
+        self.assertEqual(results, [f"0x{i:02x}" for i in range(50)])
+        self.assertEqual(len(fake.requests), 1)
+        self.assertEqual(len(fake.requests[0]), 50)
+
+    def test_identical_calls_are_coalesced(self):
+        results, fake = self.run_against_server(
+            lambda client: [client.eth_call("0xtoken", "0x01") for _ in range(10)])
+        self.assertEqual(results, ["0x01"] * 10)
+        self.assertEqual(len(fake.requests[0]), 1)
+
+    def test_errors_reach_their_callers(self):
+        results, fake = self.run_against_server(
+            lambda client: [client.eth_call("0xtoken", "0x01"), client.call("eth_unknown")])
+        self.assertEqual(results[0], "0x01")
+        self.assertIsInstance(results[1], RPCError)
+        self.assertEqual(results[1].args[0]["message"], "method not found")
@@ -10,7 +10,8 @@ from django.contrib.auth.models import User
 
 from api.permissions import IsUserOrReadOnly, CanVerify, IsChainVerified
 from api.helper import process_base64_image, paginate_queryset
-from .level import ChainManager
+from .exceptions import ImpossibleTransaction, InvalidInput, ZeroAmount
+from .level import BalanceCache, ChainManager
 from .serializers import (
     ChainPageSerializer,
     TransferableUserSerializer,
@@ -29,8 +30,8 @@ class TransferRequestViewSet(ModelViewSet):
     chain_manager = ChainManager()
 
     def list(self, request, *args, **kwargs) -> Response:
-        query_set: QuerySet[TransferRequest] = TransferRequest.objects\
-            .exclude(verified_by__in=[request.user])
+        query_set: QuerySet[TransferRequest] = TransferRequest.with_verifications(request.user)\
+            .filter(approved=False, is_verified=False).order_by("id")
         page_index: int = int(request.query_params.get("page", 1))
         page, paginator = paginate_queryset(
             query_set,
@@ -42,7 +43,7 @@ class TransferRequestViewSet(ModelViewSet):
             'count': paginator.count,
             'has_next': page.has_next(),
             'results': TransferRequestSerializer(
-                query_set,
+                page.object_list,
                 many=True,
                 context={'request': request}).data
         })
@@ -100,15 +101,17 @@ class ChainPageViewSet(ModelViewSet):
             return Response({'detail': 'bad data'}, status=405)
         if not user.chainpage.is_verified():
             return Response({'detail': 'user is not verified'}, status=405)
-        ChainManager().send(
-            ChainManager.Functions.SEND_TOKEN,
-            request.user.chainpage.wallet_address,
-            user.chainpage.wallet_address,
-            amount
-        )
+        try:
+            ChainManager().send(
+                ChainManager.Functions.SEND_TOKEN,
+                request.user.chainpage.wallet_address,
+                user.chainpage.wallet_address,
+                amount
+            )
+        except (ImpossibleTransaction, InvalidInput, ZeroAmount):
+            return Response({'detail': 'transaction could not be made'}, status=405)
         return Response({
-            'data': self.chain_manager
-            .chain_attributes(request.user.chainpage.wallet_address).__dict__()
+            'data': BalanceCache().get(request.user.chainpage.wallet_address).__dict__()
         })
 
     @action(detail=False, methods=['POST'], permission_classes=[IsChainVerified])
@@ -118,15 +121,17 @@ class ChainPageViewSet(ModelViewSet):
         amount: int | None = request.data.get("amount")
         if not amount or not address:
             return Response({'detail': 'bad data'}, status=405)
-        ChainManager().send(
-            ChainManager.Functions.SEND_TOKEN,
-            request.user.chainpage.wallet_address,
-            address,
-            amount
-        )
+        try:
+            ChainManager().send(
+                ChainManager.Functions.SEND_TOKEN,
+                request.user.chainpage.wallet_address,
+                address,
+                amount
+            )
+        except (ImpossibleTransaction, InvalidInput, ZeroAmount):
+            return Response({'detail': 'transaction could not be made'}, status=405)
         return Response({
-            'data': self.chain_manager
-            .chain_attributes(request.user.chainpage.wallet_address).__dict__()
+            'data': BalanceCache().get(request.user.chainpage.wallet_address).__dict__()
         })
 
     @action(detail=False, methods=['PATCH'], permission_classes=[IsAuthenticated])
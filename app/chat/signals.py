@@ -1,3 +1,4 @@
+from django.db import transaction
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 
@@ -12,25 +13,20 @@ def on_message_pre_save(sender, instance: Message, *args, **kwargs) -> None:
         return
     if instance.seen_by.all().count() == instance.room.participants.all().count():
         instance.seen = True
-        message_action_to_layer_celery(instance, 'seen')
+        transaction.on_commit(lambda: message_action_to_layer_celery.delay(instance.id, instance.room_id, 'seen'))
     if instance.saved:
-        message_action_to_layer_celery(instance, 'saved')
+        transaction.on_commit(lambda: message_action_to_layer_celery.delay(instance.id, instance.room_id, 'saved'))
 
 
 @receiver(post_save, sender=Message)
 def on_message_saved(sender, instance: Message, created: bool, **kwargs) -> None:
     if created:
-        for user in instance.room.participants.all():
-            if user == instance.author:
-                continue
-            send_text_notification(
-                to=user,
-                sender=instance.author,
-                message_data=instance.content,
-                message_type=instance.type
-            )
+        recipients: list[int] = list(
+            instance.room.participants.exclude(id=instance.author_id).values_list("id", flat=True))
         instance.seen_by.add(instance.author)
-        send_message_to_layer_celery(instance)
+        transaction.on_commit(lambda: send_text_notification.delay(
+            recipients, instance.author_id, instance.content, instance.type))
+        transaction.on_commit(lambda: send_message_to_layer_celery.delay(instance.id))
 
 
 @receiver(post_save, sender=Room)
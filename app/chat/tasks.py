@@ -1,35 +1,27 @@
 import asyncio
 from celery import shared_task
-from django.contrib.auth.models import User
 
-from api.models import Notification
+from api.models import UnreadCounter
 from .models import Message, Room
 from .manager import send_message_to_layer, message_action_to_layer
 from .serializers import MessageSerializer
 
 
 @shared_task
-def update_notifications(user: User) -> None:
-    for notification in Notification.objects.filter(user=user, show_on_profile=False):
-        notification.read = True
-        notification.save()
+def update_notifications(user_id: int) -> None:
+    UnreadCounter().mark_read(user_id, show_on_profile=False)
 
 
 @shared_task
-def send_message_to_layer_celery(message: Message) -> None:
-    participants: list[str] = [
-        participant.username
-        for participant in message.room.participants.all()
-    ]
+def send_message_to_layer_celery(message_id: int) -> None:
+    message: Message = Message.objects.select_related("room").get(id=message_id)
+    participants: list[str] = list(message.room.participants.values_list("username", flat=True))
     message_data = MessageSerializer(message).data
     asyncio.run(send_message_to_layer(participants, message_data))
 
 
 @shared_task
-def message_action_to_layer_celery(message: Message, action: str = 'seen') -> None:
-    participants: list[str] = [
-        participant.username
-        for participant in message.room.participants.all()
-    ]
-    message_id, room_id = message.id, message.room.id
+def message_action_to_layer_celery(message_id: int, room_id: int, action: str = 'seen') -> None:
+    participants: list[str] = list(
+        Room.objects.get(id=room_id).participants.values_list("username", flat=True))
     asyncio.run(message_action_to_layer(participants, message_id, room_id, action))
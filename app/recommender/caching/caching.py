@@ -1,14 +1,37 @@
+from typing import Iterable
+
 from django_redis import get_redis_connection
 from redis import Redis
 
-from api.helper import Singleton
+from api.helper import Singleton, chunked
+
+# KEYS: temp:<user>, u2p:<user>, cached_posts:, cached_users:  ARGV: user id
+# Returns {-1} when no posts are cached, {0} when the user is not cached, otherwise {1, seed post}
+RECOMMENDATION_SEED_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    return {-1}
+end
+if redis.call('SISMEMBER', KEYS[4], ARGV[1]) == 0 then
+    return {0}
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SINTERSTORE', KEYS[1], KEYS[2], KEYS[3])
+end
+local seed = redis.call('SRANDMEMBER', KEYS[1])
+if not seed then
+    seed = redis.call('SRANDMEMBER', KEYS[3])
+end
+return {1, seed}
+"""
 
 
 class CacheManager(metaclass=Singleton):
     cache: Redis
+    chunk_size: int = 1000
 
     def __init__(self) -> None:
         self.cache: Redis = get_redis_connection()
+        self.recommendation_seed_script = self.cache.register_script(RECOMMENDATION_SEED_SCRIPT)
 
     def add_relation(self, relation: str, subject_id: int, item_id: int, unique: bool = False) -> bool:
         if unique:
@@ -25,13 +48,58 @@ class CacheManager(metaclass=Singleton):
             return self.cache.get(f"{relation}:{subject_id}")
         return self.cache.smembers(f"{relation}:{subject_id}")
 
-    def delete_regex(self, reg_expression: str) -> int:
-        count: int = 0
-        for key in self.cache.scan_iter(reg_expression):
+    def add_relations_bulk(self, relation: str, relations: Iterable[tuple[int, int]], unique: bool = False) -> int:
+        added: int = 0
+        for chunk in chunked(relations, self.chunk_size):
+            pipeline = self.cache.pipeline(transaction=False)
+            for subject_id, item_id in chunk:
+                if unique:
+                    pipeline.set(f"{relation}:{subject_id}", item_id)
+                else:
+                    pipeline.sadd(f"{relation}:{subject_id}", item_id)
+            added += sum(int(result) for result in pipeline.execute())
+        return added
+
+    # Fills a staging set and renames it over the old one, readers never see a half written relation
+    def replace_relation(self, relation: str, subject_id: int | str, item_ids: Iterable[int]) -> int:
+        key: str = f"{relation}:{subject_id}"
+        staging_key: str = f"staging:{key}"
+        self.cache.delete(staging_key)
+        added: int = 0
+        for chunk in chunked(item_ids, self.chunk_size):
+            added += self.cache.sadd(staging_key, *chunk)
+        if added:
+            self.cache.rename(staging_key, key)
+        else:
             self.cache.delete(key)
-            count += 1
+        return added
+
+    def get_relations_many(self, relation: str, subject_ids: Iterable[int], unique: bool = False) -> list:
+        results: list = []
+        for chunk in chunked(subject_ids, self.chunk_size):
+            keys: list[str] = [f"{relation}:{subject_id}" for subject_id in chunk]
+            if unique:
+                results += self.cache.mget(keys)
+                continue
+            pipeline = self.cache.pipeline(transaction=False)
+            for key in keys:
+                pipeline.smembers(key)
+            results += pipeline.execute()
+        return results
+
+    def delete_pattern(self, pattern: str) -> int:
+        count: int = 0
+        for chunk in chunked(self.cache.scan_iter(match=pattern, count=self.chunk_size), self.chunk_size):
+            count += self.cache.unlink(*chunk)
         return count
 
+    def recommendation_seed(self, user_id: int) -> tuple[int, bytes | None]:
+        result: list = self.recommendation_seed_script(
+            keys=[f"temp:{user_id}", f"u2p:{user_id}", "cached_posts:", "cached_users:"],
+            args=[user_id]
+        )
+        return int(result[0]), result[1] if len(result) > 1 else None
+
     @staticmethod
     def u2u_to_dict(db: Redis) -> dict:
         raise NotImplementedError()
@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from api.helper import Singleton, chunked
+from blog.models import MasterPost
+from recommender.caching.caching import CacheManager
+from recommender.models import Follow
+from recommender.recommend import Recommender
+
+
+# Every user's feed is a sorted set feed:<user> of post ids ranked by (score, date_posted),
+# packed into one sorted set score by rank(), ties fall back to the post id.
+# Posts of followed authors are pushed into it when they are created (fan-out on write),
+# recommendations are merged in again whenever the post model publishes a new version.
+# Authors with more than fanout_limit followers are not pushed, readers pull their
+# recent posts instead (fan-out on read) from the feed_pull_authors: set.
+class Feed(metaclass=Singleton):
+    size: int = 500
+    ttl: timedelta = timedelta(days=7)
+    fanout_limit: int = 5000
+    pull_window: timedelta = timedelta(days=3)
+    # a fresh post of a followed author ranks like a very similar post with the following bonus
+    followee_post_score: float = 1.0 + Recommender.following_bonus
+    # scores are kept to score_precision, timestamps stay below date_span until 2286
+    score_precision: int = 1000
+    date_span: int = 10 ** 10
+
+    def __init__(self) -> None:
+        self.cache_manager = CacheManager()
+        self.recommender = Recommender()
+
+    @staticmethod
+    def key(user_id: int) -> str:
+        return f"feed:{user_id}"
+
+    @staticmethod
+    def version_key(user_id: int) -> str:
+        return f"feed_version:{user_id}"
+
+    @classmethod
+    def rank(cls, score: float, date_posted: datetime) -> float:
+        return round(score * cls.score_precision) * cls.date_span + int(date_posted.timestamp())
+
+    def ranks(self, scores: dict[int, float]) -> dict[int, float]:
+        dates = MasterPost.objects.filter(id__in=scores).values_list("id", "date_posted")
+        return {post_id: self.rank(scores[post_id], date_posted) for post_id, date_posted in dates}
+
+    def push(self, user_ids: list[int], scores: dict[int, float]) -> None:
+        if not scores:
+            return
+        pipeline = self.cache_manager.cache.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.zadd(self.key(user_id), scores)
+            pipeline.zremrangebyrank(self.key(user_id), 0, -self.size - 1)
+            pipeline.expire(self.key(user_id), self.ttl)
+        pipeline.execute()
+
+    def fan_out(self, post: MasterPost) -> int:
+        followers = Follow.objects.filter(
+            followee_id=post.author_id,
+            follow_status=Follow.Status.FOLLOWING
+        ).values_list("follower_id", flat=True)
+        if followers.count() > self.fanout_limit:
+            self.cache_manager.cache.sadd("feed_pull_authors:", post.author_id)
+            return 0
+        self.cache_manager.cache.srem("feed_pull_authors:", post.author_id)
+
+        pushed: int = 0
+        for chunk in chunked(followers.iterator(), self.cache_manager.chunk_size):
+            self.push(chunk, {post.id: self.rank(self.followee_post_score, post.date_posted)})
+            pushed += len(chunk)
+        return pushed
+
+    def pull(self, user: User) -> None:
+        authors = self.cache_manager.cache.sinter(f"u2u:{user.id}", "feed_pull_authors:")
+        if not authors:
+            return
+        posts = MasterPost.objects.filter(
+            author_id__in=[int(author) for author in authors],
+            date_posted__gte=timezone.now() - self.pull_window
+        ).values_list("id", "date_posted")
+        ranks: dict[int, float] = {
+            post_id: self.rank(self.followee_post_score, date_posted) for post_id, date_posted in posts}
+        if ranks:
+            self.cache_manager.cache.zadd(self.key(user.id), ranks, nx=True)
+
+    # Merges the recommendations of the published post model unless the feed already has them
+    def refresh(self, user: User) -> None:
+        stored = self.cache_manager.cache.get(self.version_key(user.id))
+        if self.recommender.post_recommender.load_latest() and stored is not None \
+                and int(stored) == self.recommender.post_recommender.version:
+            return
+        scores: dict = self.recommender.recommended_post_scores(user)
+        self.push([user.id], self.ranks(scores))
+        # a failed recommendation comes back empty and is tried again on the next request
+        if scores and self.recommender.post_recommender.version is not None:
+            self.cache_manager.cache.set(
+                self.version_key(user.id), self.recommender.post_recommender.version, ex=self.ttl)
+
+    def prepare(self, user: User) -> None:
+        self.refresh(user)
+        self.pull(user)
+
+    def count(self, user: User) -> int:
+        return self.cache_manager.cache.zcard(self.key(user.id))
+
+    def slice(self, user: User, start: int, stop: int) -> list[int]:
+        return [int(post_id) for post_id in self.cache_manager.cache.zrevrange(self.key(user.id), start, stop - 1)]
+
+    # Entries ranked below position (rank, post id), best first
+    def after(self, user: User, position: tuple[float, int] | None, count: int) -> list[tuple[int, float]]:
+        key: str = self.key(user.id)
+        if position is None:
+            entries = self.cache_manager.cache.zrevrange(key, 0, count - 1, withscores=True)
+        else:
+            rank, member = position[0], str(position[1]).encode()
+            ties: int = self.cache_manager.cache.zcount(key, rank, rank)
+            entries = [
+                (post_id, score) for post_id, score in self.cache_manager.cache.zrevrangebyscore(
+                    key, rank, "-inf", start=0, num=count + ties, withscores=True)
+                if score < rank or post_id < member
+            ]
+        return [(int(post_id), score) for post_id, score in entries[:count]]
+
+    # Entries ranked above position, nearest first
+    def before(self, user: User, position: tuple[float, int], count: int) -> list[tuple[int, float]]:
+        key: str = self.key(user.id)
+        rank, member = position[0], str(position[1]).encode()
+        ties: int = self.cache_manager.cache.zcount(key, rank, rank)
+        entries = [
+            (post_id, score) for post_id, score in self.cache_manager.cache.zrangebyscore(
+                key, rank, "+inf", start=0, num=count + ties, withscores=True)
+            if score > rank or post_id > member
+        ]
+        return [(int(post_id), score) for post_id, score in entries[:count]]
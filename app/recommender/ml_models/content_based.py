@@ -1,19 +1,44 @@
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator
+import json
+import pickle
+import shutil
+
+from django.conf import settings
+from django.db.models import QuerySet
 from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
-from sklearn.metrics.pairwise import linear_kernel, cosine_similarity
+from sklearn.preprocessing import normalize
+from scipy.sparse import spmatrix, vstack, save_npz, load_npz
 import pandas as pd
 import numpy as np
 
 from blog.models import MasterPost, Tag
-from recommender.preproccess.nlp import process
+from recommender.preproccess.nlp import ProcessedTextCache
 from recommender.caching.caching import CacheManager
+from recommender.ml_models.similarity import TopKIndex
 from subjects.models import Profile
 
 
 class ContentBasedModel:
+    name: str = "model"
+    top_k: int = 100
+    # the index keeps top_k * oversample candidates per item, rescore() picks the top_k of them
+    oversample: int = 1
+    block_size: int = 1024
+    artifact_format: int = 4
+    item_arrays: tuple[str, ...] = ()
+    kept_versions: int = 2
+    # bounds how long a crashed trainer can keep others from publishing
+    lock_timeout: int = 60 * 60
+
     def __init__(self):
         self.id_to_index: pd.Series | None = None
         self.index_to_id: pd.Series | None = None
-        self.sim_matrix: np.ndarray | None = None
+        self.sim_index: TopKIndex | None = None
+        self.features: list[tuple[float, spmatrix]] = []
+        self.version: int | None = None
         self.tfdif = TfidfVectorizer(lowercase=False, stop_words=None, token_pattern="(?u)\\b\\w\\w*\\b")
         self.count = CountVectorizer(lowercase=False, stop_words=None, token_pattern="(?u)\\b\\w\\w*\\b")
         self.cache_manager = CacheManager()
@@ -22,71 +47,280 @@ class ContentBasedModel:
         self.id_to_index = pd.Series(df.index, index=df["id"])
         self.index_to_id = pd.Series(df["id"])
 
+    # Held while a version is built and published, so none is published on top of an older one
+    def lock(self):
+        return self.cache_manager.cache.lock(f"model_lock:{self.name}", timeout=self.lock_timeout)
+
     def cache_to_redis(self, cache_name: str):
-        self.cache_manager.cache.delete(f"{cache_name}:")
-        for id in self.index_to_id:
-            self.cache_manager.add_relation(cache_name, "", id)
+        self.cache_manager.replace_relation(cache_name, "", self.index_to_id.tolist())
 
     def calculate_similarity_matrix(self):
         raise NotImplementedError()
 
-    def recommend(self, item_id: int):
-        index_in_matrix = self.id_to_index[item_id]
-        enum = [
-            (int(self.index_to_id[item_indice]), float(sim_score))
-            for item_indice, sim_score
-            in enumerate(self.sim_matrix[index_in_matrix])
+    def artifacts_dir(self, version: int) -> Path:
+        return Path(settings.RECOMMENDER_ARTIFACTS_DIR) / self.name / str(version)
+
+    def published_version(self) -> int | None:
+        version = self.cache_manager.cache.get(f"model_version:{self.name}")
+        return int(version) if version is not None else None
+
+    # Writes the trained model under a new version and publishes it once every file is in place.
+    # The index and the id map are read back memory-mapped, the rest is only needed to fold new items in.
+    def save(self) -> int:
+        version: int = self.cache_manager.cache.incr(f"model_version_counter:{self.name}")
+        directory: Path = self.artifacts_dir(version)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        self.sim_index.save(directory)
+        np.save(directory / "ids.npy", self.index_to_id.to_numpy(dtype=np.int64))
+        for name in self.item_arrays:
+            np.save(directory / f"{name}.npy", getattr(self, name))
+        for position, (weight, matrix) in enumerate(self.features):
+            save_npz(directory / f"features_{position}.npz", matrix, compressed=False)
+        with open(directory / "vectorizers.pkl", "wb") as f:
+            pickle.dump((self.tfdif, self.count), f)
+        with open(directory / "meta.json", "w") as f:
+            json.dump({
+                'format': self.artifact_format,
+                'size': len(self.sim_index),
+                'k': self.sim_index.k,
+                'weights': [weight for weight, matrix in self.features],
+                'created': str(datetime.now()),
+                **self.extra_meta()
+            }, f)
+
+        self.cache_manager.cache.set(f"model_version:{self.name}", version)
+        self.version = version
+        self.remove_old_versions()
+        return version
+
+    # Processes still mapping a removed version keep their pages until they load the next one
+    def remove_old_versions(self) -> None:
+        versions: list[int] = sorted(
+            int(path.name) for path in self.artifacts_dir(0).parent.iterdir() if path.name.isdigit())
+        for version in versions[:-self.kept_versions]:
+            shutil.rmtree(self.artifacts_dir(version), ignore_errors=True)
+
+    def read_meta(self, version: int) -> dict | None:
+        try:
+            with open(self.artifacts_dir(version) / "meta.json") as f:
+                meta: dict = json.load(f)
+        except FileNotFoundError:
+            return None
+        return meta if meta['format'] == self.artifact_format else None
+
+    def extra_meta(self) -> dict:
+        return dict()
+
+    def load_extra_meta(self, meta: dict) -> None:
+        pass
+
+    # Maps the latest published version unless it is already loaded, returns whether the model can recommend.
+    # A version removed while it was being mapped leaves the loaded one in place until the next call.
+    def load_latest(self) -> bool:
+        version: int | None = self.published_version()
+        if version is None or version == self.version:
+            return self.is_trained()
+        meta: dict | None = self.read_meta(version)
+        if meta is None:
+            return self.is_trained()
+
+        directory: Path = self.artifacts_dir(version)
+        try:
+            ids: np.ndarray = np.load(directory / "ids.npy")
+            sim_index: TopKIndex = TopKIndex.load(directory)
+            arrays: dict[str, np.ndarray] = {
+                name: np.load(directory / f"{name}.npy", mmap_mode="r") for name in self.item_arrays}
+        except FileNotFoundError as e:
+            print(f"{self.name} version {version} removed while loading: {e}")
+            return self.is_trained()
+        self.sim_index = sim_index
+        self.id_to_index = pd.Series(np.arange(len(ids)), index=ids)
+        self.index_to_id = pd.Series(ids)
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.load_extra_meta(meta)
+        self.features = []
+        self.version = version
+        return True
+
+    def load_features(self) -> bool:
+        meta: dict | None = self.read_meta(self.version) if self.version is not None else None
+        if meta is None:
+            return False
+        directory: Path = self.artifacts_dir(self.version)
+        try:
+            features: list[tuple[float, spmatrix]] = [
+                (weight, load_npz(directory / f"features_{position}.npz").tocsr())
+                for position, weight in enumerate(meta['weights'])
+            ]
+            with open(directory / "vectorizers.pkl", "rb") as f:
+                self.tfdif, self.count = pickle.load(f)
+        except FileNotFoundError as e:
+            print(f"{self.name} version {self.version} removed while loading: {e}")
+            return False
+        self.features = features
+        return True
+
+    def build_index(self, features: list[tuple[float, spmatrix]]):
+        self.features = features
+        self.sim_index = TopKIndex.build(
+            features, k=self.top_k * self.oversample, block_size=self.block_size, column_scale=self.column_scale())
+
+    def is_trained(self) -> bool:
+        return self.sim_index is not None
+
+    # Adds unseen terms of document to an already fitted vectorizer and returns its vector.
+    # New terms get the idf of a single occurrence; the rest of the idf table is kept until the next refit.
+    # The tf-idf transformer checks the feature count it was fitted with, it is moved along with the vocabulary.
+    @staticmethod
+    def fold_in(vectorizer: CountVectorizer, document: str, documents: int) -> spmatrix:
+        terms: list[str] = [
+            term for term in dict.fromkeys(vectorizer.build_analyzer()(document))
+            if term not in vectorizer.vocabulary_
         ]
-        return dict(enum)
+        for term in terms:
+            vectorizer.vocabulary_[term] = len(vectorizer.vocabulary_)
+        counts: spmatrix = CountVectorizer.transform(vectorizer, [document])
+        if not isinstance(vectorizer, TfidfVectorizer):
+            return counts
+        if terms:
+            idf: float = np.log((1 + documents) / 2) + 1
+            vectorizer.idf_ = np.concatenate([vectorizer.idf_, np.full(len(terms), idf)])
+            transformer = getattr(vectorizer, "_tfidf", None)
+            if hasattr(transformer, "n_features_in_"):
+                transformer.n_features_in_ = len(vectorizer.vocabulary_)
+        return normalize(counts.multiply(vectorizer.idf_).tocsr())
+
+    # rows[i] are the feature vectors of item_ids[i], in the same order as self.features.
+    # The feature matrices are stacked once, every item is then ranked against the items before it.
+    def add_items(self, item_ids: list[int], rows: list[list[spmatrix]]) -> None:
+        start: int = len(self.sim_index)
+        features: list[tuple[float, spmatrix]] = []
+        for position, (weight, matrix) in enumerate(self.features):
+            new_rows: list[spmatrix] = [item_rows[position] for item_rows in rows]
+            width: int = max(row.shape[1] for row in new_rows)
+            for row in [matrix] + new_rows:
+                row.resize(row.shape[0], width)
+            features.append((weight, vstack([matrix] + new_rows, format="csr")))
+        self.features = features
+
+        similarity: np.ndarray = TopKIndex.block_similarity(self.features, slice(start, start + len(item_ids)))
+        column_scale: np.ndarray | None = self.column_scale()
+        for offset, item_id in enumerate(item_ids):
+            index: int = start + offset
+            self.sim_index.append(
+                similarity[offset:offset + 1, :index + 1],
+                self.top_k * self.oversample,
+                column_scale[:index + 1] if column_scale is not None else None
+            )
+            self.id_to_index[item_id] = index
+            self.index_to_id[index] = item_id
+
+    # Divides every column of the similarities candidates are selected by, items hold their place in it
+    def column_scale(self) -> np.ndarray | None:
+        return None
+
+    # Adjusts the stored similarities of the neighbours at query time, the index itself is never touched
+    def rescore(self, neighbours: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        return scores
+
+    # Matrix indices of the neighbours of item_id and their scores.
+    # An item published after the loaded version is replaced by a random item of the index.
+    def neighbours(self, item_id: int) -> tuple[np.ndarray, np.ndarray]:
+        index: int | None = self.id_to_index.get(item_id)
+        if index is None:
+            index = np.random.randint(len(self.sim_index))
+        neighbours, scores = self.sim_index.row(index)
+        scores = self.rescore(neighbours, scores)
+        if len(scores) > self.top_k:
+            best: np.ndarray = np.argpartition(-scores, self.top_k - 1)[:self.top_k]
+            neighbours, scores = neighbours[best], scores[best]
+        return neighbours, scores
+
+    def to_ids(self, neighbours: np.ndarray, scores: np.ndarray) -> dict[int, float]:
+        ids = self.index_to_id.to_numpy()[neighbours]
+        return dict(zip(ids.tolist(), scores.tolist()))
+
+    def recommend(self, item_id: int) -> dict[int, float]:
+        return self.to_ids(*self.neighbours(item_id))
 
 
 class UserRecommender(ContentBasedModel):
+    name: str = "users"
     follow_weight: float = .75
     data_weight: float = .25
 
-    def follows_by_id(self, id: int):
-        following_set: set = self.cache_manager.get_relation("follow", id)
-        following_set.add("b" + str(id))
-        return str(following_set).replace(",", "").replace("'", "").strip("{}")
+    def follows_by_ids(self, ids: list[int]) -> Iterator[str]:
+        following_sets: list[set] = self.cache_manager.get_relations_many("follow", ids)
+        for id, following_set in zip(ids, following_sets):
+            yield " ".join([f"b{id}"] + [f"b{member.decode()}" for member in following_set])
 
     @staticmethod
-    def __user_serializer(user: Profile) -> dict:
-        return {
-            'id': user.id,
-            'data': f"{user.about if user.about is not None else ''} COMMON{user.id}"
-        }
+    def __user_data(id: int, about: str | None) -> str:
+        return f"{about if about is not None else ''} COMMON{id}"
 
     def calculate_similarity_matrix(self):
-        users: list[dict] = [self.__user_serializer(user) for user in Profile.objects.all()]
+        users: list[tuple[int, str | None]] = list(Profile.objects.values_list("id", "about"))
 
-        df: pd.DataFrame = pd.DataFrame(users)
+        df: pd.DataFrame = pd.DataFrame(users, columns=["id", "about"])
         self.set_id_index(df)
 
-        df["follows"] = df["id"]
-        df["follows"] = df["follows"].apply(self.follows_by_id)
-
-        tfidf_matrix = self.tfdif.fit_transform(df["follows"])
-        count_matrix = self.count.fit_transform(df["data"])
+        tfidf_matrix = self.tfdif.fit_transform(self.follows_by_ids(df["id"].tolist())).tocsr()
+        count_matrix = normalize(self.count.fit_transform(
+            self.__user_data(id, about) for id, about in users)).tocsr()
 
-        tfidf_matrix = linear_kernel(tfidf_matrix, tfidf_matrix)
-        count_matrix = cosine_similarity(count_matrix, count_matrix)
-
-        self.sim_matrix = count_matrix * self.data_weight + tfidf_matrix * self.follow_weight
-
-        self.cache_to_redis("cached_users")
+        self.build_index([
+            (self.data_weight, count_matrix),
+            (self.follow_weight, tfidf_matrix)
+        ])
 
 
+# Candidates are selected by similarity decayed to the training time. Decay moves every post by the same
+# factor per day, so the candidates stay the best ones; oversample covers the posts a day boundary reorders.
 class PostRecommender(ContentBasedModel):
+    name: str = "posts"
+    oversample: int = 2
+    item_arrays: tuple[str, ...] = ("dates", "authors")
     delay_rate: float = 1.2
     contents_weight: float = .4
     metadata_weight: float = .8
+    chunk_size: int = 2000
+
+    def __init__(self):
+        super().__init__()
+        self.dates: np.ndarray | None = None
+        self.authors: np.ndarray | None = None
+        self.reference: np.datetime64 | None = None
+        self.processed_texts = ProcessedTextCache(self.cache_manager.cache)
+
+    @staticmethod
+    def to_datetime64(dates: pd.Series) -> np.ndarray:
+        return pd.to_datetime(dates, utc=True).dt.tz_convert(None).to_numpy().astype("datetime64[s]")
+
+    # Posts lose delay_rate times their score for each full day they are older than tomorrow
+    def calculate_delays(self, dates: np.ndarray, now: np.datetime64 | None = None) -> np.ndarray:
+        if now is None:
+            now = np.datetime64(datetime.utcnow(), "s")
+        days: np.ndarray = (now + np.timedelta64(1, "D") - dates) // np.timedelta64(1, "D")
+        return np.power(self.delay_rate, days.astype(np.float64))
+
+    def extra_meta(self) -> dict:
+        return {'reference': int(self.reference.astype(np.int64))}
+
+    def load_extra_meta(self, meta: dict) -> None:
+        self.reference = np.datetime64(meta['reference'], "s")
+
+    def column_scale(self) -> np.ndarray:
+        return self.calculate_delays(self.dates, self.reference)
+
+    # Stored scores are decayed to the reference time, they are moved to the current one
+    def rescore(self, neighbours: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        dates: np.ndarray = self.dates[neighbours]
+        return scores * self.calculate_delays(dates, self.reference) / self.calculate_delays(dates)
 
-    def calculate_delays(self, df: pd.DataFrame) -> np.ndarray:
-        tomorrow = (pd.Timestamp.now() + pd.Timedelta(days=1)).tz_localize("utc")
-        df["date"] = tomorrow - df["date"]
-        df["date"] = df["date"].apply(lambda x: x.days)
-        delay_arr = np.array(df["date"])
-        return np.array(list(map(lambda x: self.delay_rate ** x, delay_arr)))
+    def authored_by(self, neighbours: np.ndarray, author_ids: Iterable) -> np.ndarray:
+        return np.isin(self.authors[neighbours], np.fromiter(map(int, author_ids), dtype=np.int64))
 
     @staticmethod
     def __stringify_content(content: dict) -> str:
@@ -94,31 +328,108 @@ class PostRecommender(ContentBasedModel):
             .replace("{", " ").replace("}", " ") \
             .replace("building_blocks", " ").replace("paragraph", " ")
 
-    def __post_serializer(self, post: MasterPost) -> dict:
-        community: str = post.community.title if post.community is not None else ""
-        author: str = post.author.username
-        tags: str = str(Tag.get_post_tags(post)).replace(",", " ").replace("[", " ").replace("]", " ")
+    @staticmethod
+    def tags_by_post(posts: QuerySet[MasterPost]) -> dict[int, list[str]]:
+        tags: dict[int, list[str]] = defaultdict(list)
+        relations = Tag.posts.through.objects \
+            .filter(masterpost__in=posts) \
+            .values_list("masterpost_id", "tag__title")
+        for post_id, title in relations.iterator():
+            tags[post_id].append(title)
+        return tags
 
+    @staticmethod
+    def __post_serializer(post: dict, contents: str, tags: str) -> dict:
+        community: str = post["community__title"] if post["community__title"] is not None else ""
         return {
-            'id': post.id,
-            'contents': f"{process(self.__stringify_content(post.content))} {post.title} COMMON{post.id}",
-            'date': post.date_posted,
-            'metadata': f"{author} {community} {process(tags)}"
+            'id': post["id"],
+            'contents': f"{contents} {post['title']} COMMON{post['id']}",
+            'date': post["date_posted"],
+            'author': post["author_id"],
+            'metadata': f"{post['author__username']} {community} {tags}"
         }
 
-    def calculate_similarity_matrix(self):
-        posts: list[dict] = [self.__post_serializer(post) for post in MasterPost.objects.all()]
+    # Texts are processed a chunk at a time so the chunk can be spread over the pool,
+    # posts whose text did not change since the last training reuse their processed text
+    def __serialize_chunk(self, posts: list[dict], tags: dict[int, list[str]], pool, rebuilding: bool) \
+            -> Iterator[dict]:
+        texts: dict[str, str] = dict()
+        for post in posts:
+            texts[f"{post['id']}:contents"] = self.__stringify_content(post["content"])
+            texts[f"{post['id']}:tags"] = " ".join(tags.get(post["id"], []))
+        processed: dict[str, str] = self.processed_texts.process(texts, pool, rebuilding)
+        for post in posts:
+            yield self.__post_serializer(
+                post, processed[f"{post['id']}:contents"], processed[f"{post['id']}:tags"])
 
-        df: pd.DataFrame = pd.DataFrame(posts)
-        self.set_id_index(df)
+    # Streams serialized posts with a single query for the posts and a single one for their tags
+    def serialized_posts(self, posts: QuerySet[MasterPost], pool=None, rebuilding: bool = False) \
+            -> Iterator[dict]:
+        tags: dict[int, list[str]] = self.tags_by_post(posts)
+        rows = posts.values(
+            "id", "title", "content", "date_posted", "author_id", "author__username", "community__title")
+        chunk: list[dict] = []
+        for post in rows.iterator(chunk_size=self.chunk_size):
+            chunk.append(post)
+            if len(chunk) == self.chunk_size:
+                yield from self.__serialize_chunk(chunk, tags, pool, rebuilding)
+                chunk = []
+        yield from self.__serialize_chunk(chunk, tags, pool, rebuilding)
+
+    # pool spreads text processing over processes, without one the corpus is processed here
+    def calculate_similarity_matrix(self, pool=None):
+        ids: list[int] = []
+        dates: list[datetime] = []
+        authors: list[int] = []
+        metadata: list[str] = []
 
-        tfdif_matrix = self.tfdif.fit_transform(df["contents"])
-        count_matrix = self.count.fit_transform(df["metadata"])
+        # contents are the bulk of the corpus, they go straight into the vectorizer without being kept
+        def contents() -> Iterator[str]:
+            for post in self.serialized_posts(MasterPost.objects.order_by("id"), pool, rebuilding=True):
+                ids.append(post["id"])
+                dates.append(post["date"])
+                authors.append(post["author"])
+                metadata.append(post["metadata"])
+                yield post["contents"]
 
-        tfidf_matrix = linear_kernel(tfdif_matrix, tfdif_matrix)
-        count_matrix = cosine_similarity(count_matrix, count_matrix)
+        self.processed_texts.start_rebuild()
+        tfidf_matrix = self.tfdif.fit_transform(contents()).tocsr()
+        count_matrix = normalize(self.count.fit_transform(metadata)).tocsr()
+        self.processed_texts.finish_rebuild()
 
-        self.sim_matrix = (tfidf_matrix * self.contents_weight + count_matrix * self.metadata_weight) / \
-                          self.calculate_delays(df)
+        self.set_id_index(pd.DataFrame({"id": ids}))
+        self.dates = self.to_datetime64(pd.Series(dates))
+        self.authors = np.array(authors, dtype=np.int64)
+        self.reference = np.datetime64(datetime.utcnow(), "s")
+        self.build_index([
+            (self.contents_weight, tfidf_matrix),
+            (self.metadata_weight, count_matrix)
+        ])
 
-        self.cache_to_redis("cached_posts")
+    # Folds posts into the latest published version and publishes the result as one new version,
+    # the posts become recommendation seeds only after that. Callers hold lock().
+    def add_posts(self, posts: QuerySet[MasterPost]) -> list[int]:
+        if not self.load_latest():
+            return []
+        if not self.features and not self.load_features():
+            return []
+        df: pd.DataFrame = pd.DataFrame(self.serialized_posts(posts.order_by("id")))
+        if not df.empty:
+            df = df[~df["id"].isin(self.id_to_index.index)]
+        if df.empty:
+            return []
+        # the new posts' dates are part of the column scale add_items ranks them with
+        self.dates = np.append(self.dates, self.to_datetime64(df["date"]))
+        self.authors = np.append(self.authors, df["author"].to_numpy(dtype=np.int64))
+        rows: list[list[spmatrix]] = []
+        for contents, metadata in zip(df["contents"], df["metadata"]):
+            documents: int = len(self.sim_index) + len(rows) + 1
+            rows.append([
+                self.fold_in(self.tfdif, contents, documents),
+                normalize(self.fold_in(self.count, metadata, documents))
+            ])
+        post_ids: list[int] = df["id"].tolist()
+        self.add_items(post_ids, rows)
+        self.save()
+        self.cache_manager.cache.sadd("cached_posts:", *post_ids)
+        return post_ids
@@ -0,0 +1,118 @@
+from pathlib import Path
+from typing import Iterable
+
+from scipy.sparse import spmatrix
+import numpy as np
+
+
+# Keeps only the k most similar items of every row instead of a dense N x N matrix.
+# neighbours[i] holds matrix indices of item i's neighbours, scores[i] their similarity,
+# both sorted by descending score.
+class TopKIndex:
+    index_dtype = np.int32
+    score_dtype = np.float32
+
+    def __init__(self, neighbours: np.ndarray, scores: np.ndarray) -> None:
+        self.neighbours: np.ndarray = neighbours
+        self.scores: np.ndarray = scores
+
+    def __len__(self) -> int:
+        return self.neighbours.shape[0]
+
+    @property
+    def k(self) -> int:
+        return self.neighbours.shape[1]
+
+    def row(self, index: int) -> tuple[np.ndarray, np.ndarray]:
+        return self.neighbours[index], self.scores[index]
+
+    def save(self, directory: Path) -> None:
+        np.save(directory / "neighbours.npy", self.neighbours)
+        np.save(directory / "scores.npy", self.scores)
+
+    # With mmap_mode="r" every process reading the same files shares their pages
+    @classmethod
+    def load(cls, directory: Path, mmap_mode: str | None = "r") -> "TopKIndex":
+        return cls(
+            np.load(directory / "neighbours.npy", mmap_mode=mmap_mode),
+            np.load(directory / "scores.npy", mmap_mode=mmap_mode)
+        )
+
+    @staticmethod
+    def block_similarity(features: Iterable[tuple[float, spmatrix]], rows: slice) -> np.ndarray:
+        block: np.ndarray | None = None
+        for weight, matrix in features:
+            partial = (matrix[rows] @ matrix.T).toarray() * weight
+            block = partial if block is None else block + partial
+        return block
+
+    @classmethod
+    def sort_rows(cls, neighbours: np.ndarray, scores: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        order = np.argsort(-scores, axis=1, kind="stable")
+        return (
+            np.take_along_axis(neighbours, order, axis=1).astype(cls.index_dtype),
+            np.take_along_axis(scores, order, axis=1).astype(cls.score_dtype)
+        )
+
+    @classmethod
+    def select_top_k(cls, block: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        if k < block.shape[1]:
+            candidates = np.argpartition(-block, kth=k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.tile(np.arange(block.shape[1]), (block.shape[0], 1))
+        return cls.sort_rows(candidates, np.take_along_axis(block, candidates, axis=1))
+
+    # Offers item index as a neighbour to every row, replacing each row's weakest neighbour it beats
+    def insert_neighbour(self, index: int, column: np.ndarray) -> None:
+        rows = np.flatnonzero(column > self.scores[:, -1])
+        if len(rows) == 0:
+            return
+        neighbours, scores = self.neighbours[rows], self.scores[rows]
+        neighbours[:, -1] = index
+        scores[:, -1] = column[rows]
+        self.neighbours[rows], self.scores[rows] = self.sort_rows(neighbours, scores)
+
+    # similarity is the 1 x (N + 1) raw similarity of a new item to every item, itself being the last one.
+    # Only the new row is ranked; existing rows take the new item through the symmetric column.
+    def append(self, similarity: np.ndarray, k: int, column_scale: np.ndarray | None = None) -> None:
+        if not self.neighbours.flags.writeable:
+            self.neighbours, self.scores = np.array(self.neighbours), np.array(self.scores)
+
+        index: int = len(self)
+        row: np.ndarray = similarity
+        column: np.ndarray = similarity[0, :index]
+        if column_scale is not None:
+            row = similarity / column_scale
+            column = column / column_scale[index]
+
+        if self.k < k:
+            self.neighbours, self.scores = self.sort_rows(
+                np.hstack([self.neighbours, np.full((index, 1), index)]),
+                np.hstack([self.scores, column[:, np.newaxis]])
+            )
+        else:
+            self.insert_neighbour(index, column)
+
+        neighbours, scores = self.select_top_k(row, self.k)
+        self.neighbours = np.vstack([self.neighbours, neighbours])
+        self.scores = np.vstack([self.scores, scores])
+
+    # features are (weight, matrix) pairs whose row-wise dot products are summed into the similarity.
+    # Rows are processed block_size at a time, so peak memory is block_size x N instead of N x N.
+    @classmethod
+    def build(cls,
+              features: list[tuple[float, spmatrix]],
+              k: int,
+              block_size: int = 1024,
+              column_scale: np.ndarray | None = None) -> "TopKIndex":
+        size: int = features[0][1].shape[0]
+        k = min(k, size)
+        neighbours = np.empty((size, k), dtype=cls.index_dtype)
+        scores = np.empty((size, k), dtype=cls.score_dtype)
+        for start in range(0, size, block_size):
+            rows = slice(start, min(start + block_size, size))
+            block = cls.block_similarity(features, rows)
+            if column_scale is not None:
+                block /= column_scale
+            neighbours[rows], scores[rows] = cls.select_top_k(block, k)
+        return cls(neighbours, scores)
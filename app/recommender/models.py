@@ -1,5 +1,5 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 
 actions = {
     "message":  0b000000010,
@@ -83,9 +83,9 @@ class Follow(models.Model):
                 if not self.followee.profile.is_private:
                     self.follow_status = self.Status.FOLLOWING
                 else:
-                    from api.notifications import engage_notification
-                    engage_notification(
-                        self.followee, self.follower,
+                    from api.tasks import send_engage_notification
+                    send_engage_notification.delay(
+                        self.followee_id, self.follower_id,
                         "follow_request", self.follower.profile.id)
                     self.follow_status = self.Status.REQUEST_SENT
         self.save()
@@ -95,8 +95,8 @@ class Follow(models.Model):
             return
         if self.follow_status == self.Status.REQUEST_SENT_FIRST:
             from api.tasks import reward_and_notify
-            reward_and_notify(
-                self.followee, self.follower,
+            reward_and_notify.delay(
+                self.followee_id, self.follower_id,
                 "follow", self.follower.profile.id
             )
         self.follow_status = self.Status.FOLLOWING
@@ -122,7 +122,11 @@ class UserPostRelation(models.Model):
 
     def toggle_like(self) -> bool:
         self.is_liked = not self.is_liked
-        self.save()
+        from blog.models import MasterPost
+
+        with transaction.atomic():
+            self.save()
+            MasterPost.move_counter(self.post_id, "like_count", 1 if self.is_liked else -1)
         return self.is_liked
 
 
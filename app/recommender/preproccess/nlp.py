@@ -1,23 +1,34 @@
+from functools import lru_cache
+from hashlib import blake2b
 from TurkishStemmer import TurkishStemmer
 import string
 import re
 
-from recommender.preproccess.stopwords import tr
+from recommender.preproccess.stopwords import en, tr
 
 
 # text normalization? zemberek-python ?
-stoplist = tr.stop_words
+stoplist: frozenset[str] = frozenset(tr.stop_words) | frozenset(en.stop_words)
 stemmer = TurkishStemmer()
+punctuation = re.compile(f"[{re.escape(string.punctuation)}]")
+
+# batches smaller than this are cheaper to process than to ship to a pool
+PARALLEL_THRESHOLD = 512
 
 
 # "I'm dealing with natural language processing." -> ["i", "m", "dealing", "with" ...]
 def tokenize_sentence(sentence: str) -> list[str]:
-    return re.sub("[" + string.punctuation + "]", "", sentence.lower()).split()
+    return punctuation.sub("", sentence.lower()).split()
+
+
+@lru_cache(maxsize=65536)
+def stem_word(word: str) -> str:
+    return stemmer.stem(word)
 
 
 # ["i", "m", "dealing", "with" ...] -> ["i", "m", "deal", "with", ...]
 def stem_sentence(sentence: list[str]) -> list[str]:
-    return [stemmer.stem(word) for word in sentence]
+    return [stem_word(word) for word in sentence]
 
 
 # ["i", "m", "deal", "with", ...] -> ["deal", "natural", "language", "process"]
@@ -31,3 +42,57 @@ def process(sentence: str) -> str:
     sentence = remove_stopwords(sentence)
     sentence = stem_sentence(sentence)
     return " ".join(sentence)
+
+
+# pool is a billiard Pool, which unlike multiprocessing's can be started from a daemonic celery worker
+def process_many(sentences: list[str], pool=None, chunksize: int = 64) -> list[str]:
+    if pool is None or len(sentences) < PARALLEL_THRESHOLD:
+        return [process(sentence) for sentence in sentences]
+    return pool.map(process, sentences, chunksize)
+
+
+# Keeps the processed text of every item in the Redis hash processed_texts:, each value is the
+# digest of the text it was computed from followed by the processed text. An item is processed
+# again only when its text changes. A full rebuild writes every item into processed_texts_building:
+# and replaces the hash with it, which drops the items that no longer exist.
+class ProcessedTextCache:
+    key: str = "processed_texts:"
+    building_key: str = "processed_texts_building:"
+    digest_size: int = 16
+
+    def __init__(self, cache) -> None:
+        self.cache = cache
+
+    @classmethod
+    def digest(cls, text: str) -> bytes:
+        return blake2b(text.encode("utf-8"), digest_size=cls.digest_size).digest()
+
+    def start_rebuild(self) -> None:
+        self.cache.delete(self.building_key)
+
+    def finish_rebuild(self) -> None:
+        if self.cache.exists(self.building_key):
+            self.cache.rename(self.building_key, self.key)
+        else:
+            self.cache.delete(self.key)
+
+    def process(self, texts: dict[str, str], pool=None, rebuilding: bool = False) -> dict[str, str]:
+        keys: list[str] = list(texts)
+        if not keys:
+            return dict()
+        digests: dict[str, bytes] = {key: self.digest(texts[key]) for key in keys}
+        processed: dict[str, str] = dict()
+        missing: list[str] = []
+        for key, entry in zip(keys, self.cache.hmget(self.key, keys)):
+            if entry is not None and entry[:self.digest_size] == digests[key]:
+                processed[key] = entry[self.digest_size:].decode("utf-8")
+            else:
+                missing.append(key)
+        for key, text in zip(missing, process_many([texts[key] for key in missing], pool)):
+            processed[key] = text
+
+        written: list[str] = keys if rebuilding else missing
+        if written:
+            self.cache.hset(self.building_key if rebuilding else self.key, mapping={
+                key: digests[key] + processed[key].encode("utf-8") for key in written})
+        return processed
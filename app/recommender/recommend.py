@@ -4,22 +4,26 @@ from django.db.models import QuerySet
 from api.helper import Singleton
 from blog.models import MasterPost
 from recommender.caching.caching import CacheManager
-from recommender.ml_models.content_based import PostRecommender, UserRecommender
+from recommender.ml_models.content_based import ContentBasedModel, PostRecommender, UserRecommender
 from subjects.models import Profile
 
 
 class Recommender(metaclass=Singleton):
     following_bonus: float = 0.3
+    fold_in_batch: int = 1000
 
     def __init__(self) -> None:
         self.cache_manager = CacheManager()
         self.post_recommender = PostRecommender()
         self.user_recommender = UserRecommender()
 
-    def update_posts(self) -> bool:
+    def update_posts(self, pool=None) -> bool:
         try:
-            self.post_recommender.calculate_similarity_matrix()
-            self.cache_manager.delete_regex("temp*")
+            with self.post_recommender.lock():
+                self.post_recommender.calculate_similarity_matrix(pool)
+                self.post_recommender.save()
+                self.post_recommender.cache_to_redis("cached_posts")
+            self.cache_manager.delete_pattern("temp:*")
             return True
         except Exception as e:
             import traceback
@@ -29,8 +33,11 @@ class Recommender(metaclass=Singleton):
 
     def update_users(self) -> bool:
         try:
-            self.user_recommender.calculate_similarity_matrix()
-            self.cache_manager.delete_regex("temp*")
+            with self.user_recommender.lock():
+                self.user_recommender.calculate_similarity_matrix()
+                self.user_recommender.save()
+                self.user_recommender.cache_to_redis("cached_users")
+            self.cache_manager.delete_pattern("temp:*")
             return True
         except Exception as e:
             import traceback
@@ -38,62 +45,85 @@ class Recommender(metaclass=Singleton):
             print(e, traceback.format_exc())
             return False
 
-    def update_recommender(self) -> bool:
-        return self.update_posts() and self.update_users()
+    def update_recommender(self, pool=None) -> bool:
+        return self.update_posts(pool) and self.update_users()
 
-    def add_post_relation(self, post: MasterPost) -> bool:
-        return self.cache_manager.add_relation("posted", post.id, post.author.id, unique=True)
+    # New posts wait in pending_posts: and are folded in fold_in_batch at a time, one version per batch
+    def queue_post(self, post_id: int) -> None:
+        self.cache_manager.add_relation("pending_posts", "", post_id)
 
-    def remove_post_relation(self, post: MasterPost) -> bool:
-        return self.cache_manager.rem_relation("posted", post.id, post.author.id, unique=True)
+    def add_pending_posts(self) -> int:
+        post_ids: list[int] = [
+            int(post_id) for post_id in self.cache_manager.cache.spop("pending_posts:", self.fold_in_batch) or []]
+        if not post_ids:
+            return 0
+        try:
+            return len(self.post_recommender.add_posts(MasterPost.objects.filter(id__in=post_ids)))
+        except Exception as e:
+            import traceback
+
+            print(e, traceback.format_exc())
+            # a half folded-in model is dropped, the next call maps the published version again
+            self.post_recommender.version = None
+            self.cache_manager.cache.sadd("pending_posts:", *post_ids)
+            return 0
 
     def __recommended_posts(self, user: User, depth: int = 0) -> dict:
-        if not self.cache_manager.cache.exists("cached_posts:"):
+        if user.is_anonymous:
+            raise Exception("User must be cached and not anonymous")
+
+        loaded: bool = self.post_recommender.load_latest()
+        if not loaded and self.post_recommender.published_version() is not None:
+            raise Exception(self.unreadable_version(self.post_recommender))
+        status, rand_post = self.cache_manager.recommendation_seed(user.id) if loaded else (-1, None)
+        if status == -1:
             if depth > 4:
                 raise Exception("Maximum depth reached")
             self.update_recommender()
             depth += 1
             return self.__recommended_posts(user, depth=depth)
-
-        if user.is_anonymous or not self.cache_manager.cache.sismember("cached_users:", f"{user.id}"):
+        if status == 0:
             raise Exception("User must be cached and not anonymous")
 
-        if not self.cache_manager.cache.exists(f"temp:{user.id}"):
-            self.cache_manager.cache.sinterstore(
-                f"temp:{user.id}", f"u2p:{user.id}", "cached_posts:")
-
-        rand_post = 1
-        if self.cache_manager.cache.exists(f"temp:{user.id}"):
-            rand_post = self.cache_manager.cache.srandmember(f"temp:{user.id}")
-        else:
-            rand_post = self.cache_manager.cache.srandmember("cached_posts:")
-
         if not rand_post:
             rand_post = 1
 
-        post_scores: dict = self.post_recommender.recommend(int(rand_post))
+        neighbours, scores = self.post_recommender.neighbours(int(rand_post))
         followings: set = self.cache_manager.get_relation("u2u", user.id)
-        for p_id in post_scores.keys():
-            if self.cache_manager.get_relation("posted", p_id, unique=True) in followings:
-                post_scores[p_id] += self.following_bonus
-        return post_scores
+        scores = scores + self.following_bonus * self.post_recommender.authored_by(neighbours, followings)
+        return self.post_recommender.to_ids(neighbours, scores)
+
+    # A published version this host can't read means the artifacts directory isn't shared with
+    # the host that trained it, retraining here would only publish a version the others can't read
+    @staticmethod
+    def unreadable_version(model: ContentBasedModel) -> str:
+        version: int = model.published_version()
+        return f"{model.name} version {version} is published but can't be read from {model.artifacts_dir(version)}"
 
     def __recommended_users(self, user: User, __depth: int = 0) -> list[int]:
         if user.is_anonymous or not self.cache_manager.cache.sismember("cached_users:", f"{user.id}"):
             raise Exception("User must be cached and not anonymous")
+        if not self.user_recommender.load_latest():
+            if self.user_recommender.published_version() is not None:
+                raise Exception(self.unreadable_version(self.user_recommender))
+            if not self.update_users():
+                raise Exception("User recommender could not be trained")
 
         user_scores = self.user_recommender.recommend(user.id)
         return sorted(user_scores.keys(), key=lambda x: user_scores[x])
 
-    def get_recommended_posts(self, user: User, posts: QuerySet[MasterPost]) -> QuerySet[MasterPost]:
+    def recommended_post_scores(self, user: User) -> dict[int, float]:
         try:
-            recommended_ids: dict = self.__recommended_posts(user)
-            return posts.filter(id__in=recommended_ids)
+            return self.__recommended_posts(user)
         except Exception as e:
             import traceback
 
             print(e, traceback.format_exc())
-            return posts
+            return dict()
+
+    def get_recommended_posts(self, user: User, posts: QuerySet[MasterPost]) -> QuerySet[MasterPost]:
+        recommended_ids: dict = self.recommended_post_scores(user)
+        return posts.filter(id__in=recommended_ids) if recommended_ids else posts
 
     def get_recommended_users(self, user: User) -> QuerySet[User] | None:
         try:
@@ -22,8 +22,8 @@ def on_follow(sender, instance: Follow, created, **kwargs):
 @receiver(post_save, sender=UserPostRelation)
 def on_like(sender, instance: UserPostRelation, created, **kwargs):
     if created:
-        reward_and_notify(instance.post.author, instance.user,
-                          "like", instance.post.id)
+        reward_and_notify.delay(instance.post.author_id, instance.user_id,
+                                "like", instance.post_id)
 
     if instance.is_liked:
         recommender.add_relation("u2p", instance.user.id, instance.post.id)
@@ -38,9 +38,9 @@ def on_join(sender, instance: RoledUser, created, **kwargs):
         room.participants.add(instance.user)
         if instance.privilege == RoledUser.Roles.admin:
             room.admins.add(instance.user)
-        reward_and_notify(
-            instance.community.get_founder(),
-            instance.user, "join", instance.community.id)
+        reward_and_notify.delay(
+            instance.community.get_founder().id,
+            instance.user_id, "join", instance.community_id)
     else:
         if instance.privilege == RoledUser.Roles.not_member \
                 or instance.privilege == RoledUser.Roles.none or instance.is_banned:
@@ -56,30 +56,30 @@ def on_join(sender, instance: RoledUser, created, **kwargs):
 @receiver(post_save, sender=CommentLike)
 def on_comment_like(sender, instance: CommentLike, created, **kwargs):
     if created:
-        reward_and_notify(
-            instance.comment.author, instance.user,
-            "like_comment", instance.comment.post.id)
+        reward_and_notify.delay(
+            instance.comment.author_id, instance.user_id,
+            "like_comment", instance.comment.post_id)
 
 
 @receiver(post_save, sender=FundableContribute)
 def on_contribute(sender, instance: FundableContribute, created, **kwargs):
     if created:
-        reward_and_notify(
-            instance.fundable.author, instance.user,
-            "contribute", instance.fundable.id)
+        reward_and_notify.delay(
+            instance.fundable.author_id, instance.user_id,
+            "contribute", instance.fundable_id)
 
 
 @receiver(post_save, sender=EventAttend)
 def on_attend(sender, instance: EventAttend, created, **kwargs):
     if created:
-        reward_and_notify(
-            instance.event.author, instance.user,
-            "attend", instance.event.id)
+        reward_and_notify.delay(
+            instance.event.author_id, instance.user_id,
+            "attend", instance.event_id)
 
 
 @receiver(post_save, sender=PostComment)
 def on_comment(sender, instance: PostComment, created, **kwargs):
     if created:
-        reward_and_notify(
-            instance.post.author, instance.user,
-            "comment", instance.post.id)
+        reward_and_notify.delay(
+            instance.post.author_id, instance.user_id,
+            "comment", instance.post_id)
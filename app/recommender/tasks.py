@@ -0,0 +1,40 @@
+from billiard import Pool
+from celery import shared_task
+
+from blog.models import MasterPost
+from recommender.feed import Feed
+from recommender.recommend import Recommender
+
+
+@shared_task(name="update_recommender")
+def update_recommender():
+    # one pool for the whole retrain, requests retraining inline never fork
+    pool = Pool()
+    try:
+        updated: bool = Recommender().update_recommender(pool)
+    finally:
+        pool.close()
+        pool.join()
+    print(f"Recommender updated: {updated}")
+
+
+# Only one process folds in or retrains at a time, posts arriving meanwhile wait for the next run
+@shared_task(name="fold_in_posts")
+def fold_in_posts():
+    recommender: Recommender = Recommender()
+    lock = recommender.post_recommender.lock()
+    if not lock.acquire(blocking=False):
+        print("Recommender is being updated")
+        return
+    try:
+        added: int = recommender.add_pending_posts()
+    finally:
+        lock.release()
+    print(f"{added} posts added to recommender.")
+
+
+@shared_task(name="fan_out_post")
+def fan_out_post(post_id: int):
+    post: MasterPost | None = MasterPost.objects.filter(id=post_id).first()
+    if post is not None:
+        Feed().fan_out(post)
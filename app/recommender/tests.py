@@ -0,0 +1,66 @@
+import numpy as np
+from django.test import SimpleTestCase
+from scipy.sparse import random as sparse_random
+from sklearn.metrics.pairwise import linear_kernel, cosine_similarity
+from sklearn.preprocessing import normalize
+
+from recommender.ml_models.content_based import PostRecommender
+from recommender.ml_models.similarity import TopKIndex
+
+
+class TopKIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        self.contents = sparse_random(200, 80, density=0.05, format="csr", random_state=1)
+        self.metadata = sparse_random(200, 20, density=0.1, format="csr", random_state=2)
+        self.delays = np.linspace(1, 3, 200)
+        self.dense = (linear_kernel(self.contents, self.contents) * .4 +
+                      cosine_similarity(self.metadata, self.metadata) * .8) / self.delays
+
+    def build(self, k: int, block_size: int) -> TopKIndex:
+        return TopKIndex.build(
+            [(.4, self.contents), (.8, normalize(self.metadata))],
+            k=k, block_size=block_size, column_scale=self.delays)
+
+    def test_matches_dense_top_k(self):
+        index = self.build(k=10, block_size=32)
+        for row in range(len(index)):
+            neighbours, scores = index.row(row)
+            expected = np.sort(self.dense[row])[::-1][:10]
+            np.testing.assert_allclose(scores, expected, atol=1e-5)
+            np.testing.assert_allclose(self.dense[row][neighbours], scores, atol=1e-5)
+
+    def test_k_larger_than_corpus(self):
+        index = self.build(k=1000, block_size=64)
+        self.assertEqual(index.k, 200)
+
+
+class RecencyDecayTestCase(SimpleTestCase):
+    def test_delays_grow_per_full_day(self):
+        recommender = PostRecommender()
+        now = np.datetime64("2022-10-20T12:00:00")
+        dates = np.array(["2022-10-20T11:00:00", "2022-10-19T13:00:00", "2022-10-17T12:00:00"],
+                         dtype="datetime64[s]")
+        np.testing.assert_allclose(
+            recommender.calculate_delays(dates, now),
+            np.power(recommender.delay_rate, [1, 1, 4])
+        )
+
+    def test_rescore_moves_reference_decay_to_now(self):
+        recommender = PostRecommender()
+        recommender.dates = np.array(["2022-10-01T00:00:00", "2022-10-15T00:00:00"], dtype="datetime64[s]")
+        recommender.reference = np.datetime64("2022-10-20T00:00:00")
+        raw = np.array([.9, .5])
+        stored = raw / recommender.calculate_delays(recommender.dates, recommender.reference)
+        np.testing.assert_allclose(
+            recommender.rescore(np.arange(2), stored),
+            raw / recommender.calculate_delays(recommender.dates)
+        )
+
+
+class FoldInTestCase(SimpleTestCase):
+    def test_vectorizer_transforms_after_fold_in(self):
+        vectorizer = PostRecommender().tfdif
+        vectorizer.fit(["kitap okuma", "okuma yazma"])
+        row = PostRecommender.fold_in(vectorizer, "kitap resim", 3)
+        self.assertEqual(row.shape[1], len(vectorizer.vocabulary_))
+        self.assertEqual(vectorizer.transform(["resim"]).shape[1], len(vectorizer.vocabulary_))
@@ -7,7 +7,7 @@ from django.core.files.base import ContentFile
 from api.dynamic_links import DynamicLinkManager
 
 from recommender.models import Follow, RoledUser
-from api.models import Notification
+from api.models import Notification, UnreadCounter
 from blog.models import MasterPost, Tag
 from api.helper import compress_image, process_base64_image
 
@@ -124,39 +124,26 @@ class Profile(Subject):
             print(e.with_traceback)
             return self.__default_recommendation()
 
-    @staticmethod
-    def read_notifications(notifications: list[Notification]) -> None:
-        for notification in notifications:
-            notification.read = True
-            notification.save()
+    def read_notifications(self, notifications: list[Notification]) -> None:
+        UnreadCounter().mark_read(
+            self.user.id, show_on_profile=True, ids=[notification.id for notification in notifications])
 
     def get_notifications(self) -> QuerySet[Notification]:
         return Notification.objects.filter(
             user=self.user, show_on_profile=True).order_by('-id')
 
     def is_profile_notifications_unread(self) -> bool:
-        notifications: list[Notification] = Notification.objects.filter(
-            user=self.user, show_on_profile=True)
-        for notification in notifications:
-            if not notification.read:
-                return True
-        return False
+        return UnreadCounter().get(self.user.id)["profile"] > 0
 
     def is_message_notifications_unread(self) -> bool:
-        notifications: list[Notification] = Notification.objects.filter(
-            user=self.user, show_on_profile=False)
-        for notification in notifications:
-            if not notification.read:
-                return True
-        return False
+        return UnreadCounter().get(self.user.id)["message"] > 0
 
     def get_link(self) -> str:
         manager = DynamicLinkManager()
         return manager.create_link(item_id=self.id, link_type="user")
 
     def follow(self, user: User) -> 'Profile':
-        from api.tasks import reward_and_notify
-        from api.notifications import engage_notification
+        from api.tasks import reward_and_notify, send_engage_notification
 
         try:
             Follow.objects.get(follower=user, followee=self.user)\
@@ -166,16 +153,16 @@ class Profile(Subject):
                 follow: Follow = Follow.objects.create(
                     follower=user, followee=self.user,
                     follow_status=Follow.Status.REQUEST_SENT_FIRST)
-                engage_notification(
-                    follow.followee, follow.follower,
-                    "follow_request", follow.follower.id)
+                send_engage_notification.delay(
+                    follow.followee_id, follow.follower_id,
+                    "follow_request", follow.follower_id)
             else:
                 follow: Follow = Follow.objects.create(
                     follower=user, followee=self.user,
                     follow_status=Follow.Status.FOLLOWING)
-                reward_and_notify(
-                    follow.followee, follow.follower,
-                    "follow", follow.follower.id
+                reward_and_notify.delay(
+                    follow.followee_id, follow.follower_id,
+                    "follow", follow.follower_id
                 )
         return self
 
@@ -7,7 +7,7 @@ from api.helper import get_profile_image
 from api.models import Notification
 from api.serializers import Base64ImageField
 from blog.models import EventPost, FundablePost
-from chain.level import ChainManager
+from chain.level import BalanceCache, ChainAttributes
 from subjects.models import Profile, Subject, Community
 from blog.models import MasterPost
 from recommender.models import Follow
@@ -148,12 +148,11 @@ class ProfileSerializer(SubjectSerializer):
         if not obj.user.chainpage.is_verified():
             return None
         try:
+            attributes: ChainAttributes = BalanceCache().get(obj.user.chainpage.wallet_address)
             return {
-                'balance': str(ChainManager().call(
-                    ChainManager.Functions.BALANCE_OF,
-                    obj.user.chainpage.wallet_address
-                )),
-                'address': obj.user.chainpage.wallet_address
+                'balance': str(attributes.balance) if attributes.balance is not None else None,
+                'address': obj.user.chainpage.wallet_address,
+                'updated': attributes.updated
             }
         except Exception as e:
             print(e)
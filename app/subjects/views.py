@@ -8,7 +8,7 @@ from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnl
 from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
 
-from api.models import Notification
+from api.models import Notification, UnreadCounter
 from blog.models import Tag
 from chat.models import Room
 from chat.serializers import RoomSerializer
@@ -187,6 +187,19 @@ class ProfileViewSet(ModelViewSet):
     def notifications(self, request: Request) -> Response:
         self.check_permissions(request)
         profile: Profile = request.user.profile
+        # ?cursor= reads the inbox by id, the next page continues below the last id returned
+        if "cursor" in request.query_params:
+            cursor: str = request.query_params.get("cursor")
+            limit: int = 50
+            page: list[Notification] = Notification.inbox(
+                request.user.id, show_on_profile=True,
+                before=int(cursor) if cursor and cursor.isdigit() else None, limit=limit + 1)
+            profile.read_notifications(page[:limit])
+            return Response({
+                'has_next': len(page) > limit,
+                'next': page[limit - 1].id if len(page) > limit else None,
+                'results': NotificationSerializer(page[:limit], many=True).data
+            })
         notifications: QuerySet[Notification] = profile.get_notifications()
         page_index: int = int(request.query_params.get("page", 1))
         page, paginator = paginate_queryset(
@@ -205,10 +218,10 @@ class ProfileViewSet(ModelViewSet):
     @action(detail=False, methods=['GET'], permission_classes=[IsAuthenticated])
     def unread_notifications(self, request: Request) -> Response:
         self.check_permissions(request)
-        profile: Profile = request.user.profile
+        counts: dict[str, int] = UnreadCounter().get(request.user.id)
         return Response({
-            'message': profile.is_message_notifications_unread(),
-            'profile': profile.is_profile_notifications_unread()
+            'message': counts["message"] > 0,
+            'profile': counts["profile"] > 0
         })
         
     @action(detail=True, methods=['GET'])
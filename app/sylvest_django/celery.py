@@ -13,6 +13,19 @@ def debug_task(self):
     print(f'Request: {self.request!r}')
 
 
+# Workers consume them with -Q celery,notifications,chain,chat, slow chain calls don't hold up notifications
+celery_app.conf.task_routes = {
+    "api.tasks.*": {"queue": "notifications"},
+    "archive_notifications": {"queue": "notifications"},
+    "chat.tasks.*": {"queue": "chat"},
+    "chain.tasks.*": {"queue": "chain"},
+    "create_transfer_log": {"queue": "chain"},
+    "flush_xp": {"queue": "chain"},
+    "refresh_balances": {"queue": "chain"},
+    "sign_transactions": {"queue": "chain"},
+    "confirm_transactions": {"queue": "chain"},
+}
+
 celery_app.conf.beat_schedule = {
     "transfer-scheduler": {
         "task": "create_transfer_log",
@@ -21,5 +34,33 @@ celery_app.conf.beat_schedule = {
     "sign-scheduler": {
         "task": "sign_transactions",
         'schedule': 10.0
+    },
+    "confirm-scheduler": {
+        "task": "confirm_transactions",
+        'schedule': 10.0
+    },
+    "xp-scheduler": {
+        "task": "flush_xp",
+        'schedule': 10.0
+    },
+    "balance-scheduler": {
+        "task": "refresh_balances",
+        'schedule': 15.0
+    },
+    "recommender-scheduler": {
+        "task": "update_recommender",
+        'schedule': 3600.0
+    },
+    "fold-in-scheduler": {
+        "task": "fold_in_posts",
+        'schedule': 60.0
+    },
+    "archive-scheduler": {
+        "task": "archive_notifications",
+        'schedule': 86400.0
+    },
+    "counter-scheduler": {
+        "task": "reconcile_post_counters",
+        'schedule': 3600.0
     }
 }
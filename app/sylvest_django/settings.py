@@ -276,6 +276,10 @@ MEDIA_URL = '/media/'
 
 LOCAL_SERVE_MEDIA_FILES = True
 
+# Every web and celery host must see the same directory, the published version in Redis points into it
+RECOMMENDER_ARTIFACTS_DIR = os.environ.get(
+    'RECOMMENDER_ARTIFACTS_DIR', os.path.join(BASE_DIR, 'recommender_artifacts'))
+
 # from decouple import config
 # S3_ENABLED = config('S3_ENABLED', cast=bool, default=True)
 # LOCAL_SERVE_MEDIA_FILES = config('LOCAL_SERVE_MEDIA_FILES', cast=bool, default=not S3_ENABLED)